@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# pylint: disable=wrong-import-position,import-error
+''' Recording and replay of event streams, to test widgets under event storms.
+
+    python3 -m benchmarks.events record FILE [--duration SECONDS]
+
+writes the events of qubesd (as the widgets get them from
+`qubesadmin.events.EventsDispatcher`) to FILE, until interrupted; run it in
+dom0 while reproducing the situation of interest, such as a mass shutdown,
+a burst of disposable VMs, USB hotplug or updates found for many templates.
+Each event is one JSON line of its time (in seconds since the first event),
+subject, name and arguments; the file is gzip-compressed if its name ends
+with `.gz`. `vm-stats` events come from a different stream and are not
+recorded.
+
+    python3 -m benchmarks.events replay FILE [--speed X] [WIDGET...]
+
+feeds the recorded events into widgets, at the recorded pace multiplied by
+X (by default 1; 0 means as fast as possible), without qubesd: the widgets
+run against `benchmarks.fake_qubes.FakeQubes`, which the events update as
+qubesd would have been (power states, features, properties, device
+attachments; device lists do not change). Domains named in the recording
+are added to the fake system. The report is printed as JSON:
+
+- handler latency: time spent in the handlers of each event, in total and
+  per event name, in seconds
+- max stall: the longest the main loop was blocked, measured as the delay
+  of a heartbeat timer, in seconds
+- max lag: the longest an event was dispatched behind schedule
+- events per second: events dispatched per second of replay
+- handler errors: number of handler calls that raised an exception; the
+  exceptions are logged and the replay goes on, as with the real dispatcher
+
+Replay needs a display and the Qubes icon theme, so run it in dom0 as well.
+'''
+import argparse
+import asyncio
+import collections
+import contextlib
+import fnmatch
+import gzip
+import importlib
+import json
+import logging
+import statistics
+import sys
+import time
+
+import gi
+gi.require_version('Gtk', '3.0')  # isort:skip
+from gi.repository import GLib  # isort:skip
+
+import qubesadmin
+import qubesadmin.events
+
+from benchmarks.fake_qubes import FakeQubes
+
+logger = logging.getLogger(__name__)
+
+#: widget name -> module providing load_widget()
+WIDGETS = {
+    'domains': 'qui.tray.domains',
+    'devices': 'qui.tray.devices',
+    'disk-space': 'qui.tray.disk_space',
+    'updates': 'qui.tray.updates',
+}
+
+#: interval of the heartbeat measuring main loop stalls, in milliseconds
+HEARTBEAT_INTERVAL = 10
+
+
+def open_recording(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class Recorder:
+    ''' Events dispatcher handler writing every event to a file '''
+
+    def __init__(self, path):
+        self.file = open_recording(path, 'w')
+        self.start = None
+        self.count = 0
+
+    def handle(self, subject, event, **kwargs):
+        if event == 'connection-established':
+            return
+        now = time.monotonic()
+        if self.start is None:
+            self.start = now
+        self.file.write(json.dumps(
+            [round(now - self.start, 6),
+             None if subject is None else str(subject), event, kwargs],
+            separators=(',', ':'), default=str))
+        self.file.write('\n')
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+
+def load_recording(path):
+    ''' Returns a list of (time, subject name, event, kwargs) '''
+    with open_recording(path, 'r') as file:
+        return [tuple(json.loads(line)) for line in file if line.strip()]
+
+
+class ReplayDispatcher(qubesadmin.events.EventsDispatcher):
+    ''' Events dispatcher fed from a recording instead of qubesd. Events are
+    applied to the fake system before they are passed to the handlers, whose
+    time is measured. '''
+
+    def __init__(self, app):
+        # caches of the fake system are kept current by apply_event
+        super().__init__(app, enable_cache=False)
+        #: event name -> time spent in handlers of each event
+        self.latencies = collections.defaultdict(list)
+        #: number of handler calls that raised an exception
+        self.errors = 0
+
+    def get_domain(self, name):
+        return self.app.domains.items.get(name) or self.app.add_domain(name)
+
+    def handle(self, subject, event, **kwargs):
+        if subject:
+            subject = self.get_domain(subject)
+        else:
+            subject = None
+        if event.startswith('device-') and 'device' in kwargs:
+            # recorded as a string; rebuild the device object as qubesadmin
+            # does for these events
+            try:
+                devclass = event.split(':', 1)[1]
+                backend_name, ident = kwargs['device'].split(':', 1)
+                kwargs['device'] = \
+                    self.get_domain(backend_name).devices[devclass][ident]
+            except (KeyError, IndexError, ValueError):
+                pass
+        self.app.apply_event(subject, event, **kwargs)
+
+        handlers = [func for pattern, funcs in self.handlers.items()
+                    if fnmatch.fnmatch(event, pattern)
+                    for func in list(funcs)]
+        start = time.perf_counter()
+        for handler in handlers:
+            try:
+                handler(subject, event, **kwargs)
+            except Exception:  # pylint: disable=broad-except
+                self.errors += 1
+                logger.exception('Failed to handle event %s', event)
+        self.latencies[event].append(time.perf_counter() - start)
+
+
+class StallMonitor:
+    ''' Heartbeat timer on the main loop, recording how late it fires '''
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL):
+        self.interval = interval / 1000
+        self.max_stall = 0
+        self.last = time.perf_counter()
+        self.source = GLib.timeout_add(interval, self.beat)
+
+    def beat(self):
+        now = time.perf_counter()
+        self.max_stall = max(self.max_stall, now - self.last - self.interval)
+        self.last = now
+        return True
+
+    def stop(self):
+        GLib.source_remove(self.source)
+
+
+async def replay(dispatcher, events, speed):
+    ''' Dispatch events at their recorded times divided by `speed`, letting
+    the main loop run between them; returns the longest delay of an event '''
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    max_lag = 0
+    for offset, subject, event, kwargs in events:
+        if speed:
+            due = start + offset / speed
+            await asyncio.sleep(max(due - loop.time(), 0))
+            max_lag = max(max_lag, loop.time() - due)
+        else:
+            await asyncio.sleep(0)
+        dispatcher.handle(subject, event, **kwargs)
+    return max_lag
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean': statistics.mean(values),
+        'median': statistics.median(values),
+        'p95': values[int(0.95 * (len(values) - 1))],
+        'max': values[-1],
+    }
+
+
+def initial_domains(events):
+    ''' Domains that exist before the recording starts, that is all named in
+    it except those added during it; returns a dict of their names and power
+    states, which are guessed from their first events '''
+    domains = {}
+    added = set()
+    for _offset, subject, event, kwargs in events:
+        if event == 'domain-add':
+            added.add(kwargs['vm'])
+        for name in (subject, kwargs.get('vm')):
+            if name and name not in added and name not in domains:
+                domains[name] = 'Halted' if event in (
+                    'domain-pre-start', 'domain-start') else 'Running'
+    return domains
+
+
+def run_record(args):
+    qapp = qubesadmin.Qubes()
+    dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+    recorder = Recorder(args.file)
+    dispatcher.add_handler('*', recorder.handle)
+
+    loop = asyncio.get_event_loop()
+    task = asyncio.ensure_future(dispatcher.listen_for_events())
+    if args.duration:
+        loop.call_later(args.duration, task.cancel)
+    try:
+        loop.run_until_complete(task)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        recorder.close()
+    print('Recorded {} events'.format(recorder.count), file=sys.stderr)
+    return 0
+
+
+def run_replay(args):
+    events = load_recording(args.file)
+    if not events:
+        print('No events in {}'.format(args.file), file=sys.stderr)
+        return 1
+
+    # import all modules before the loop is created, as each of them
+    # installs gbulb
+    modules = [importlib.import_module(WIDGETS[name])
+               for name in args.widgets or WIDGETS]
+
+    qapp = FakeQubes(domains=args.domains, devices=args.devices,
+                     pools=args.pools, latency=args.latency)
+    for name, state in initial_domains(events).items():
+        if name not in qapp.domains.items:
+            qapp.add_domain(name, state=state)
+    dispatcher = ReplayDispatcher(qapp)
+
+    loop = asyncio.get_event_loop()
+    apps = []
+    with contextlib.redirect_stdout(sys.stderr):
+        for module in modules:
+            # worker threads of the widgets use the fake system as well
+            app, coroutines = module.load_widget(
+                qapp, dispatcher, qapp_factory=lambda: qapp)
+            apps.append(app)
+            # coroutines listen to qubesd, which is not there
+            for coroutine in coroutines:
+                coroutine.close()
+
+        monitor = StallMonitor()
+        start = time.perf_counter()
+        max_lag = loop.run_until_complete(
+            replay(dispatcher, events, args.speed))
+        duration = time.perf_counter() - start
+        # let timers started by the handlers run
+        loop.run_until_complete(asyncio.sleep(args.settle))
+        monitor.stop()
+
+    latencies = [value for values in dispatcher.latencies.values()
+                 for value in values]
+    print(json.dumps({
+        'events': len(events),
+        'duration': duration,
+        'events_per_second': len(events) / duration if duration else None,
+        'max_stall': monitor.max_stall,
+        'max_lag': max_lag,
+        'handler_latency': summarize(latencies),
+        'handler_latency_by_event': {
+            event: summarize(values)
+            for event, values in dispatcher.latencies.items()},
+        'admin_api_calls': sum(qapp.calls.values()),
+        'handler_errors': dispatcher.errors,
+    }, indent=2, sort_keys=True))
+    del apps
+    return 0
+
+
+parser = argparse.ArgumentParser(
+    description='Record events of qubesd, or replay them into widgets.')
+subparsers = parser.add_subparsers(dest='command')
+subparsers.required = True
+
+record_parser = subparsers.add_parser(
+    'record', help='record events until interrupted')
+record_parser.add_argument('file', metavar='FILE')
+record_parser.add_argument('--duration', type=float,
+                           help='stop after this many seconds')
+record_parser.set_defaults(func=run_record)
+
+replay_parser = subparsers.add_parser(
+    'replay', help='replay recorded events into widgets')
+replay_parser.add_argument('file', metavar='FILE')
+replay_parser.add_argument('--speed', type=float, default=1.0,
+                           help='replay speed, 0 for as fast as possible '
+                                '(default: 1)')
+replay_parser.add_argument('--domains', type=int, default=100,
+                           help='number of simulated domains (default: 100)')
+replay_parser.add_argument('--devices', type=int, default=30,
+                           help='number of simulated devices (default: 30)')
+replay_parser.add_argument('--pools', type=int, default=3,
+                           help='number of simulated pools (default: 3)')
+replay_parser.add_argument('--latency', type=float, default=0.001,
+                           help='latency of an Admin API call, in seconds '
+                                '(default: 0.001)')
+replay_parser.add_argument('--settle', type=float, default=2.0,
+                           help='seconds to keep the main loop running after '
+                                'the last event (default: 2)')
+replay_parser.add_argument(
+    'widgets', metavar='WIDGET', nargs='*',
+    help='widgets to replay events into, from: {} (default: all)'.format(
+        ', '.join(WIDGETS)))
+replay_parser.set_defaults(func=run_replay)
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    if args.command == 'replay':
+        for name in args.widgets:
+            if name not in WIDGETS:
+                parser.error('unknown widget: {}'.format(name))
+        if args.speed < 0:
+            parser.error('--speed must not be negative')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+''' In-process stand-in for `qubesadmin.Qubes`, for benchmarks.
+
+`FakeQubes` simulates a system with a given number of domains, devices and
+storage pools. It implements the part of the qubesadmin object model the
+widgets use. Whatever the real objects would fetch from qubesd goes through
+`FakeQubes.qubesd_call`, which counts calls per Admin API method and sleeps
+for the configured latency. Like qubesadmin, properties and power states are
+cached only if `cache_enabled` is set. Unlike qubesadmin objects, a `FakeQubes`
+object can be shared with worker threads, so widgets making Qubes objects
+of their own for them get it from a factory returning the same object.
+'''
+import collections
+import random
+import time
+
+LABELS = ('red', 'orange', 'yellow', 'green', 'gray', 'blue', 'purple',
+          'black')
+DEVCLASSES = ('block', 'usb', 'mic')
+GiB = 1024 ** 3
+
+#: power state of a domain after an event
+EVENT_STATES = {
+    'domain-pre-start': 'Transient',
+    'domain-start': 'Running',
+    'domain-start-failed': 'Halted',
+    'domain-paused': 'Paused',
+    'domain-unpaused': 'Running',
+    'domain-pre-shutdown': 'Transient',
+    'domain-shutdown': 'Halted',
+    'domain-shutdown-failed': 'Running',
+}
+
+
+class FakeLabel:
+    def __init__(self, name):
+        self.name = name
+        self.icon = 'appvm-' + name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeCollection:
+    ''' Named objects, listed with one Admin API call '''
+
+    def __init__(self, app, list_method):
+        self.app = app
+        self.list_method = list_method
+        self.items = collections.OrderedDict()
+
+    def _list(self):
+        self.app.qubesd_call('dom0', self.list_method)
+        return self.items
+
+    def __iter__(self):
+        return iter(list(self._list().values()))
+
+    def __getitem__(self, name):
+        if str(name) not in self._list():
+            raise KeyError(name)
+        return self.items[str(name)]
+
+    def __contains__(self, name):
+        return str(name) in self._list()
+
+    def get_blind(self, name):
+        ''' Look an object up without listing the collection '''
+        return self.items[str(name)]
+
+    def __len__(self):
+        return len(self._list())
+
+    def keys(self):
+        return list(self._list().keys())
+
+    def values(self):
+        return list(self._list().values())
+
+
+class FakeFeatures:
+    def __init__(self, vm, features):
+        self.vm = vm
+        self.features = {name: value for name, value in features.items()
+                         if value is not None}
+
+    def keys(self):
+        self.vm.qubesd_call('admin.vm.feature.List')
+        return list(self.features)
+
+    def __getitem__(self, name):
+        self.vm.qubesd_call('admin.vm.feature.Get', name)
+        return self.features[name]
+
+    def __setitem__(self, name, value):
+        self.vm.qubesd_call('admin.vm.feature.Set', name)
+        self.features[name] = value
+
+    def __delitem__(self, name):
+        self.vm.qubesd_call('admin.vm.feature.Remove', name)
+        del self.features[name]
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+
+class FakeDevice:
+    def __init__(self, backend_domain, devclass, ident, description,
+                 data=None):
+        self.backend_domain = backend_domain
+        self.devclass = devclass
+        self.ident = ident
+        self.description = description
+        self.data = data or {}
+
+    def __str__(self):
+        return '{}:{}'.format(self.backend_domain, self.ident)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+
+class FakeDeviceCollection:
+    def __init__(self, vm, devclass):
+        self.vm = vm
+        self.devclass = devclass
+        #: devices provided by the VM
+        self.available = []
+        #: devices attached to the VM
+        self.assigned = []
+
+    def __iter__(self):
+        self.vm.qubesd_call(
+            'admin.vm.device.{}.Available'.format(self.devclass))
+        return iter(list(self.available))
+
+    def __getitem__(self, ident):
+        ''' A device provided by the VM; like qubesadmin, an unknown one is
+        returned as a device without description '''
+        return next((device for device in self if device.ident == ident),
+                    FakeDevice(self.vm, self.devclass, ident, ident))
+
+    def attached(self):
+        self.vm.qubesd_call('admin.vm.device.{}.List'.format(self.devclass))
+        return list(self.assigned)
+
+    def attach(self, _assignment):
+        self.vm.qubesd_call('admin.vm.device.{}.Attach'.format(self.devclass))
+
+    def detach(self, _assignment):
+        self.vm.qubesd_call('admin.vm.device.{}.Detach'.format(self.devclass))
+
+
+class FakeVolume:
+    def __init__(self, vm, name, size, usage):
+        self.vm = vm
+        self.name = name
+        self._size = size
+        self._usage = usage
+
+    @property
+    def size(self):
+        self.vm.qubesd_call('admin.vm.volume.Info', self.name)
+        return self._size
+
+    @property
+    def usage(self):
+        self.vm.qubesd_call('admin.vm.volume.Info', self.name)
+        return self._usage
+
+
+class FakeVM:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, app, name, klass, label, state='Halted',
+                 template=None, netvm=None, updateable=False, features=None):
+        self.app = app
+        self.name = name
+        self.klass = klass
+        self._properties = {'label': app.labels[label], 'netvm': netvm,
+                            'updateable': updateable}
+        if template is not None:
+            self._properties['template'] = template
+        self.state = state
+        self._cache = {}
+        self.features = FakeFeatures(self, features or {})
+        self.devices = {devclass: FakeDeviceCollection(self, devclass)
+                        for devclass in DEVCLASSES}
+        self._volumes = {}
+
+    def add_volume(self, name, size, usage):
+        self._volumes[name] = FakeVolume(self, name, size, usage)
+
+    def set_state(self, state):
+        self.state = state
+        self._cache.pop('_power_state', None)
+
+    def set_property(self, name, value):
+        ''' Set a property from its value in an event '''
+        if name == 'label':
+            value = self.app.labels.get(value, value)
+        elif name in ('template', 'netvm'):
+            value = self.app.domains.items.get(value, value or None)
+        self._properties[name] = value
+        self._cache.pop(name, None)
+
+    def qubesd_call(self, method, arg=None):
+        return self.app.qubesd_call(self.name, method, arg)
+
+    def _get_property(self, name):
+        if name in self._cache:
+            return self._cache[name]
+        self.qubesd_call('admin.vm.property.Get', name)
+        if name not in self._properties:
+            raise AttributeError(name)
+        value = self._properties[name]
+        if self.app.cache_enabled:
+            self._cache[name] = value
+        return value
+
+    def _fetch_all_properties(self):
+        self.qubesd_call('admin.vm.property.GetAll')
+        if not self.app.cache_enabled:
+            return False
+        self._cache.update(self._properties)
+        return True
+
+    @property
+    def label(self):
+        return self._get_property('label')
+
+    @property
+    def netvm(self):
+        return self._get_property('netvm')
+
+    @property
+    def updateable(self):
+        return self._get_property('updateable')
+
+    @property
+    def template(self):
+        return self._get_property('template')
+
+    @property
+    def volumes(self):
+        self.qubesd_call('admin.vm.volume.List')
+        return dict(self._volumes)
+
+    def get_power_state(self):
+        if '_power_state' in self._cache:
+            return self._cache['_power_state']
+        self.qubesd_call('admin.vm.CurrentState')
+        if self.app.cache_enabled:
+            self._cache['_power_state'] = self.state
+        return self.state
+
+    def is_running(self):
+        return self.get_power_state() != 'Halted'
+
+    def is_paused(self):
+        return self.get_power_state() == 'Paused'
+
+    def is_halted(self):
+        return self.get_power_state() == 'Halted'
+
+    def get_disk_utilization(self):
+        return sum(volume.usage for volume in self.volumes.values())
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<FakeVM {}>'.format(self.name)
+
+    def __eq__(self, other):
+        if isinstance(other, FakeVM):
+            return self.name == other.name
+        if isinstance(other, str):
+            return self.name == other
+        return NotImplemented
+
+    def __lt__(self, other):
+        return self.name < str(other)
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+class FakePool:
+    def __init__(self, app, name, size, usage, driver='lvm_thin'):
+        self.app = app
+        self.name = name
+        self.driver = driver
+        self._size = size
+        self._usage = usage
+
+    @property
+    def config(self):
+        self.app.qubesd_call('dom0', 'admin.pool.Info', self.name)
+        return {'driver': self.driver, 'name': self.name}
+
+    @property
+    def usage_details(self):
+        self.app.qubesd_call('dom0', 'admin.pool.UsageDetails', self.name)
+        return {'data_size': self._size, 'data_usage': self._usage,
+                'metadata_size': self._size // 100,
+                'metadata_usage': self._usage // 200}
+
+    @property
+    def size(self):
+        return self.usage_details['data_size']
+
+    @property
+    def usage(self):
+        return self.usage_details['data_usage']
+
+    def __str__(self):
+        return self.name
+
+
+class FakeQubes:
+    ''' A synthetic system: dom0, templates (one per 20 domains), sys-net,
+    sys-firewall, sys-usb providing the devices and AppVMs, of which the
+    `running` fraction is running. Generated from `seed`, so that runs are
+    comparable. '''
+
+    def __init__(self, domains=10, devices=10, pools=2, latency=0.0,
+                 running=0.5, seed=0):
+        self.latency = latency
+        #: Admin API method -> number of calls
+        self.calls = collections.Counter()
+        self.cache_enabled = False
+        self.labels = {name: FakeLabel(name) for name in LABELS}
+        self.domains = FakeCollection(self, 'admin.vm.List')
+        self.pools = FakeCollection(self, 'admin.pool.List')
+
+        rand = random.Random(seed)
+        self._create_domains(domains, running, rand)
+        self._create_devices(devices, rand)
+        for i in range(pools):
+            size = rand.randint(100, 2000) * GiB
+            self.pools.items['pool-{}'.format(i)] = FakePool(
+                self, 'pool-{}'.format(i), size,
+                int(size * rand.uniform(0.1, 0.95)))
+
+    def qubesd_call(self, dest, method, arg=None, payload=None):
+        # pylint: disable=unused-argument
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return b''
+
+    def add_domain(self, name, klass='AppVM', label='red', state='Halted'):
+        ''' Add a domain based on the first template, without devices '''
+        template = next(vm for vm in self.domains.items.values()
+                        if vm.klass == 'TemplateVM')
+        vm = FakeVM(self, name, klass, label, state, template=template,
+                    netvm=self.domains.items.get('sys-firewall'))
+        vm.add_volume('private', 2 * GiB, GiB // 2)
+        self.domains.items[name] = vm
+        return vm
+
+    def apply_event(self, subject, event, **kwargs):
+        ''' Update the system as qubesd has before sending `event`; devices
+        are passed as objects, as the events dispatcher passes them to
+        handlers '''
+        # pylint: disable=too-many-branches
+        name = event.split(':', 1)[0]
+        if event == 'domain-add':
+            if kwargs['vm'] not in self.domains.items:
+                self.add_domain(kwargs['vm'])
+        elif event == 'domain-delete':
+            self.domains.items.pop(kwargs['vm'], None)
+        elif event == 'pool-add':
+            self.pools.items[kwargs['pool']] = FakePool(
+                self, kwargs['pool'], 100 * GiB, 0)
+        elif event == 'pool-delete':
+            self.pools.items.pop(kwargs['pool'], None)
+        elif subject is None:
+            pass
+        elif event in EVENT_STATES:
+            subject.set_state(EVENT_STATES[event])
+        elif name == 'domain-feature-set':
+            subject.features.features[kwargs['feature']] = kwargs['value']
+        elif name == 'domain-feature-delete':
+            subject.features.features.pop(kwargs['feature'], None)
+        elif name == 'property-set':
+            subject.set_property(kwargs['name'], kwargs['newvalue'])
+        elif name in ('device-attach', 'device-detach'):
+            self._apply_device_event(subject, event, kwargs['device'])
+
+    @staticmethod
+    def _apply_device_event(subject, event, device):
+        name, devclass = event.split(':', 1)
+        if devclass not in subject.devices:
+            return
+        assigned = subject.devices[devclass].assigned
+        if name == 'device-attach' and device not in assigned:
+            assigned.append(device)
+        elif name == 'device-detach' and device in assigned:
+            assigned.remove(device)
+
+    def _add_vm(self, vm, rand):
+        if vm.klass != 'AdminVM':
+            size = rand.randint(2, 50) * GiB
+            vm.add_volume('private', size,
+                          int(size * rand.uniform(0.05, 0.98)))
+        if vm.klass == 'TemplateVM':
+            vm.add_volume('root', 20 * GiB,
+                          int(20 * GiB * rand.uniform(0.3, 0.9)))
+        self.domains.items[vm.name] = vm
+        return vm
+
+    def _create_domains(self, count, running, rand):
+        self._add_vm(FakeVM(self, 'dom0', 'AdminVM', 'black', 'Running',
+                            features={'updates-available': 1}), rand)
+        templates = [
+            self._add_vm(FakeVM(
+                self, 'template-{}'.format(i), 'TemplateVM', 'black',
+                updateable=True, features={
+                    'updates-available': rand.random() < 0.3 or None,
+                    'qrexec': 1, 'gui': 1, 'os': 'Linux'}), rand)
+            for i in range(max(1, count // 20))]
+        sys_net = self._add_vm(FakeVM(
+            self, 'sys-net', 'AppVM', 'red', 'Running',
+            template=templates[0]), rand)
+        sys_firewall = self._add_vm(FakeVM(
+            self, 'sys-firewall', 'AppVM', 'green', 'Running',
+            template=templates[0], netvm=sys_net), rand)
+        self._add_vm(FakeVM(
+            self, 'sys-usb', 'AppVM', 'red', 'Running',
+            template=templates[0]), rand)
+
+        for i in range(max(0, count - len(self.domains.items))):
+            self._add_vm(FakeVM(
+                self, 'qube-{}'.format(i), 'AppVM',
+                LABELS[i % len(LABELS)],
+                'Running' if rand.random() < running else 'Halted',
+                template=templates[i % len(templates)],
+                netvm=sys_firewall), rand)
+
+    def _create_devices(self, count, rand):
+        backend = self.domains.items['sys-usb']
+        running = [vm for vm in self.domains.items.values()
+                   if vm.klass == 'AppVM' and vm.state == 'Running'
+                   and vm is not backend]
+        for i in range(count):
+            devclass = DEVCLASSES[i % len(DEVCLASSES)]
+            device = FakeDevice(
+                backend, devclass, '{}-{}'.format(devclass, i),
+                'Synthetic {} device {}'.format(devclass, i),
+                {'size': str(rand.randint(1, 64) * GiB)}
+                if devclass == 'block' else None)
+            backend.devices[devclass].available.append(device)
+            # attach every third device
+            if running and i % 3 == 0:
+                rand.choice(running).devices[devclass].assigned.append(device)
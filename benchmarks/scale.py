@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# pylint: disable=wrong-import-position,import-error
+''' Synthetic-scale benchmark of the widgets.
+
+The widgets are run against `benchmarks.fake_qubes.FakeQubes`, which
+simulates a system of the given number of domains, devices and storage
+pools, with a configurable latency of every Admin API call, so qubesd is
+not needed. The operations below are measured at each size; each run uses
+a fresh fake system and widget, which are set up outside of the measured
+time:
+
+- DomainTray.initialize_menu: building the domains menu
+- DevicesTray.__init__: listing devices at startup
+- DevicesTray.show_menu: opening the devices menu, until it is drawn
+- DiskSpace.refresh_icon: polling every pool and volume, as after a long
+  idle period, until the icon is updated
+- UpdatesTray.check_vms_needing_update: finding domains with updates
+- QubesUpdater.populate_vm_list: listing domains in the updater
+
+Results are printed as JSON: the time of the first run (with empty icon
+caches), the median, minimum and maximum over all runs, in seconds, and
+the number of Admin API calls of a run, in total and per method. Output of
+the widgets goes to stderr. GTK needs a display and the Qubes icon theme,
+so run this in dom0, from the top directory of the repository:
+
+    python3 -m benchmarks.scale [--domains N [N ...]] [--latency SECONDS]
+'''
+import argparse
+import asyncio
+import contextlib
+import gc
+import itertools
+import json
+import statistics
+import sys
+import time
+
+import gi
+gi.require_version('Gtk', '3.0')  # isort:skip
+from gi.repository import Gtk  # isort:skip
+
+import qubesadmin.events
+
+# importing the widgets installs gbulb
+from qui import updater
+from qui.tray import devices
+from qui.tray import disk_space
+from qui.tray import domains
+from qui.tray import updates
+
+from benchmarks.fake_qubes import FakeQubes
+
+_app_ids = itertools.count()
+
+
+def app_id(name):
+    # every widget instance needs an application ID of its own
+    return 'org.qubes.qui.benchmark.{}{}'.format(name, next(_app_ids))
+
+
+def process_events():
+    while Gtk.events_pending():
+        Gtk.main_iteration_do(False)
+
+
+def setup_domains_menu(qapp, dispatcher):
+    stats_dispatcher = qubesadmin.events.EventsDispatcher(
+        qapp, api_method='admin.vm.Stats')
+    app = domains.DomainTray(
+        app_id('Domains'), qapp, dispatcher, stats_dispatcher,
+        qapp_factory=lambda: qapp)
+    return app.initialize_menu
+
+
+def setup_devices_startup(qapp, dispatcher):
+    return lambda: devices.DevicesTray(app_id('Devices'), qapp, dispatcher,
+                                       qapp_factory=lambda: qapp)
+
+
+def setup_devices_menu(qapp, dispatcher):
+    app = devices.DevicesTray(app_id('Devices'), qapp, dispatcher,
+                              qapp_factory=lambda: qapp)
+
+    def show_menu():
+        app.show_menu(None, None)
+        process_events()
+        app.tray_menu.popdown()
+    return show_menu
+
+
+def setup_disk_space(qapp, dispatcher):
+    app = disk_space.DiskSpace(qapp, dispatcher, qapp_factory=lambda: qapp)
+    loop = asyncio.get_event_loop()
+    # the widget starts with a refresh of its own
+    loop.run_until_complete(app.queries.refresh_future)
+
+    def refresh_icon():
+        app.scheduler.next_poll.clear()
+        app.refresh_icon()
+        loop.run_until_complete(app.queries.refresh_future)
+    return refresh_icon
+
+
+def setup_updates(qapp, dispatcher):
+    app = updates.UpdatesTray(app_id('Updates'), qapp, dispatcher)
+    return app.check_vms_needing_update
+
+
+def setup_updater(qapp, _dispatcher):
+    app = updater.QubesUpdater(qapp)
+    # normally loaded from updater.glade by perform_setup
+    app.vm_list = Gtk.ListBox()
+    return app.populate_vm_list
+
+
+#: benchmark name -> function setting up a widget and returning the
+#: operation to measure
+BENCHMARKS = {
+    'DomainTray.initialize_menu': setup_domains_menu,
+    'DevicesTray.__init__': setup_devices_startup,
+    'DevicesTray.show_menu': setup_devices_menu,
+    'DiskSpace.refresh_icon': setup_disk_space,
+    'UpdatesTray.check_vms_needing_update': setup_updates,
+    'QubesUpdater.populate_vm_list': setup_updater,
+}
+
+parser = argparse.ArgumentParser(
+    description='Measure widgets on a simulated system of a given size.')
+parser.add_argument('--domains', type=int, nargs='+', default=[10, 100, 500],
+                    metavar='N',
+                    help='numbers of domains to simulate '
+                         '(default: 10 100 500)')
+parser.add_argument('--devices', type=int, default=30,
+                    help='number of devices (default: 30)')
+parser.add_argument('--pools', type=int, default=3,
+                    help='number of storage pools (default: 3)')
+parser.add_argument('--latency', type=float, default=0.001,
+                    help='latency of an Admin API call, in seconds '
+                         '(default: 0.001)')
+parser.add_argument('--runs', type=int, default=3,
+                    help='number of runs of each benchmark (default: 3)')
+parser.add_argument(
+    'benchmarks', metavar='BENCHMARK', nargs='*',
+    help='benchmarks to run, from: {} (default: all)'.format(
+        ', '.join(BENCHMARKS)))
+
+
+def run_once(setup, args, domain_count):
+    qapp = FakeQubes(domains=domain_count, devices=args.devices,
+                     pools=args.pools, latency=args.latency)
+    dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+    with contextlib.redirect_stdout(sys.stderr):
+        operation = setup(qapp, dispatcher)
+        qapp.calls.clear()
+        start = time.perf_counter()
+        operation()
+        elapsed = time.perf_counter() - start
+    calls = dict(qapp.calls)
+    del operation
+    gc.collect()
+    return elapsed, calls
+
+
+def measure(name, args, domain_count):
+    times = []
+    calls = {}
+    for _ in range(args.runs):
+        elapsed, calls = run_once(BENCHMARKS[name], args, domain_count)
+        times.append(elapsed)
+    return {
+        'benchmark': name,
+        'domains': domain_count,
+        'first': times[0],
+        'median': statistics.median(times),
+        'min': min(times),
+        'max': max(times),
+        'calls': sum(calls.values()),
+        'calls_by_method': calls,
+    }
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    names = args.benchmarks or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {}'.format(name))
+    if args.runs < 1:
+        parser.error('--runs must be at least 1')
+
+    results = [measure(name, args, domain_count)
+               for domain_count in args.domains
+               for name in names]
+    print(json.dumps({
+        'parameters': {
+            'devices': args.devices,
+            'pools': args.pools,
+            'latency': args.latency,
+            'runs': args.runs,
+        },
+        'results': results,
+    }, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+''' Startup benchmark of the widgets.
+
+Every widget is started in a fresh interpreter, several times, and the
+median of the following is reported, in seconds:
+
+- import: importing the widget module, with everything it pulls in
+- first icon: from the start of the import until the widget is created and
+  the main loop has become idle for the first time, that is when its tray
+  icon is shown
+- total: wall time of the whole process, including interpreter startup
+
+Medians are compared with the budget of each widget; the exit code is 1 if
+any budget is exceeded, so that slower logins are noticed. The widgets talk
+to qubesd, so run this in dom0, in the desktop session, from the top
+directory of the repository:
+
+    python3 -m benchmarks.startup [--runs N] [--json] [WIDGET...]
+'''
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: widget name -> (module, import budget, first icon budget)
+WIDGETS = {
+    'domains': ('qui.tray.domains', 0.5, 1.5),
+    'devices': ('qui.tray.devices', 0.5, 1.5),
+    'disk-space': ('qui.tray.disk_space', 0.5, 1.5),
+    'updates': ('qui.tray.updates', 0.5, 1.5),
+    'clipboard': ('qui.clipboard', 0.5, 1.0),
+    # the updater has no tray icon, only its import is measured
+    'updater': ('qui.updater', 0.5, None),
+}
+
+parser = argparse.ArgumentParser(
+    description='Measure startup time of the widgets.')
+parser.add_argument('--runs', type=int, default=5,
+                    help='number of runs of each widget (default: 5)')
+parser.add_argument('--json', action='store_true',
+                    help='print results as JSON')
+parser.add_argument('--child', metavar='MODULE', help=argparse.SUPPRESS)
+parser.add_argument(
+    'widgets', metavar='WIDGET', nargs='*',
+    help='widgets to measure, from: {} (default: all)'.format(
+        ', '.join(WIDGETS)))
+
+
+def run_child(module_name):
+    ''' Import and start one widget, then print timings as JSON '''
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    result = {'import': time.perf_counter() - start, 'first_icon': None}
+
+    if hasattr(module, 'load_widget'):
+        # pylint: disable=import-error
+        import asyncio
+        import qubesadmin
+        import qubesadmin.events
+        from gi.repository import GLib
+
+        qapp = qubesadmin.Qubes()
+        dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+        loop = asyncio.get_event_loop()
+
+        _app, coroutines = module.load_widget(qapp, dispatcher)
+        for coroutine in coroutines:
+            coroutine.close()
+
+        def first_idle():
+            loop.stop()
+            return False
+
+        GLib.idle_add(first_idle)
+        loop.run_forever()
+        result['first_icon'] = time.perf_counter() - start
+
+    print(json.dumps(result))
+
+
+def measure(module_name, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'benchmarks.startup',
+             '--child', module_name], cwd=ROOT)
+        sample = json.loads(output.decode().splitlines()[-1])
+        sample['total'] = time.perf_counter() - start
+        samples.append(sample)
+
+    result = {}
+    for key in ('import', 'first_icon', 'total'):
+        values = [sample[key] for sample in samples
+                  if sample[key] is not None]
+        result[key] = statistics.median(values) if values else None
+    return result
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    if args.child:
+        run_child(args.child)
+        return 0
+
+    names = args.widgets or list(WIDGETS)
+    for name in names:
+        if name not in WIDGETS:
+            parser.error('unknown widget: {}'.format(name))
+
+    results = {}
+    exit_code = 0
+    for name in names:
+        module_name, import_budget, icon_budget = WIDGETS[name]
+        result = measure(module_name, args.runs)
+        result['over_budget'] = result['import'] > import_budget or (
+            icon_budget is not None and result['first_icon'] is not None
+            and result['first_icon'] > icon_budget)
+        if result['over_budget']:
+            exit_code = 1
+        results[name] = result
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return exit_code
+
+    print('{:<12}{:>10}{:>12}{:>10}'.format(
+        'widget', 'import', 'first icon', 'total'))
+    for name, result in results.items():
+        print('{:<12}{:>10.3f}{:>12}{:>10.3f}{}'.format(
+            name, result['import'],
+            '-' if result['first_icon'] is None
+            else '{:.3f}'.format(result['first_icon']),
+            result['total'],
+            '  OVER BUDGET' if result['over_budget'] else ''))
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
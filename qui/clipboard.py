@@ -262,13 +262,21 @@ class NotificationApp(Gtk.Application):
         self.send_notification(self.get_application_id(), notification)
 
 
-def main():
+def load_widget(_qapp, _dispatcher):
+    ''' Create the widget for `qui.tray.host`; the clipboard widget does not
+    use qubesd, it only watches clipboard files '''
     loop = asyncio.get_event_loop()
     wm = pyinotify.WatchManager()
     gtk_app = NotificationApp(wm)
 
     handler = EventHandler(loop=loop, gtk_app=gtk_app)
     pyinotify.AsyncioNotifier(wm, loop, default_proc_fun=handler)
+    return gtk_app, []
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    load_widget(None, None)
     loop.run_forever()
 
 
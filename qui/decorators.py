@@ -10,12 +10,32 @@ from gi.repository import Gtk, Pango  # isort:skip
 from qubesadmin import exc
 from qubesadmin.utils import size_to_human
 
+import qui.icons
+
 import gettext
 t = gettext.translation("desktop-linux-manager", localedir="/usr/locales",
                         fallback=True)
 _ = t.gettext
 
 
+class LabelUpdateCounter:
+    ''' Counts stats label updates, and how many of them were skipped
+    because the label would not visibly change '''
+
+    def __init__(self):
+        self.rendered = 0
+        self.skipped = 0
+
+    def hit_rate(self):
+        total = self.rendered + self.skipped
+        if total == 0:
+            return 0
+        return self.skipped / total
+
+
+LABEL_UPDATES = LabelUpdateCounter()
+
+
 class PropertiesDecorator():
     ''' Base class for all decorators '''
 
@@ -41,7 +61,7 @@ class DomainDecorator(PropertiesDecorator):
         self.vm = vm
 
     class VMName(Gtk.Box):
-        def __init__(self, vm):
+        def __init__(self, vm, updates_state=None):
             super(DomainDecorator.VMName, self).__init__()
             self.vm = vm
 
@@ -71,7 +91,7 @@ class DomainDecorator(PropertiesDecorator):
                 _("Qube must be restarted to reflect changes in template"))
 
             self.update_outdated(False)
-            self.update_updateable()
+            self.update_updateable(updates_state)
 
             self.pack_start(self.outdated_icon, False, False, 3)
             self.pack_start(self.updateable_icon, False, True, 3)
@@ -81,14 +101,16 @@ class DomainDecorator(PropertiesDecorator):
             self.outdated = state
             self.update_tooltip()
 
-        def update_updateable(self):
+        def update_updateable(self, updates_state=None):
             if self.vm is None or not getattr(self.vm, 'updateable', False):
                 return
-            try:
-                updates_state = self.vm.features.get('updates-available', False)
-            except exc.QubesException:
-                # no access to VM features
-                updates_state = False
+            if updates_state is None:
+                try:
+                    updates_state = self.vm.features.get(
+                        'updates-available', False)
+                except exc.QubesException:
+                    # no access to VM features
+                    updates_state = False
             self.updateable_icon.set_visible(updates_state)
             self.updates_available = updates_state
             self.update_tooltip()
@@ -157,8 +179,8 @@ class DomainDecorator(PropertiesDecorator):
 
             self.label.set_tooltip_markup(tooltip)
 
-    def name(self):
-        namebox = DomainDecorator.VMName(self.vm)
+    def name(self, updates_state=None):
+        namebox = DomainDecorator.VMName(self.vm, updates_state)
         return namebox
 
     class VMCPU(Gtk.Box):
@@ -169,16 +191,32 @@ class DomainDecorator(PropertiesDecorator):
             self.cpu_label.set_width_chars(6)
             self.pack_start(self.cpu_label, True, True, 0)
 
+            self.last_markup = None
+            self.insensitive_color = None
+            self.cpu_label.connect('style-updated', self.reset_color)
+
+        def reset_color(self, *_args):
+            self.insensitive_color = None
+            self.last_markup = None
+
         def update_state(self, cpu=0, header=False):
             if header:
                 markup = _('<b>CPU</b>')
             elif cpu > 0:
                 markup = '{:3d}%'.format(cpu)
             else:
-                color = self.cpu_label.get_style_context() \
-                            .get_color(Gtk.StateFlags.INSENSITIVE).to_color()
-                markup = '<span color="{}">0%</span>'.format(color.to_string())
-
+                if self.insensitive_color is None:
+                    color = self.cpu_label.get_style_context() \
+                        .get_color(Gtk.StateFlags.INSENSITIVE).to_color()
+                    self.insensitive_color = color.to_string()
+                markup = '<span color="{}">0%</span>'.format(
+                    self.insensitive_color)
+
+            if markup == self.last_markup:
+                LABEL_UPDATES.skipped += 1
+                return
+            LABEL_UPDATES.rendered += 1
+            self.last_markup = markup
             self.cpu_label.set_markup(markup)
 
     class VMMem(Gtk.Box):
@@ -187,12 +225,19 @@ class DomainDecorator(PropertiesDecorator):
             self.mem_label = Gtk.Label(xalign=1)
             self.pack_start(self.mem_label, True, True, 0)
 
+            self.last_markup = None
+
         def update_state(self, memory=0, header=False):
             if header:
                 markup = _('<b>RAM</b>')
             else:
                 markup = '{} MB'.format(str(int(memory/1024)))
 
+            if markup == self.last_markup:
+                LABEL_UPDATES.skipped += 1
+                return
+            LABEL_UPDATES.rendered += 1
+            self.last_markup = markup
             self.mem_label.set_markup(markup)
 
     def memory(self):
@@ -218,8 +263,7 @@ class DomainDecorator(PropertiesDecorator):
         except exc.QubesDaemonCommunicationError:
             # no permission to access icon
             icon = 'appvm-black'
-        icon_vm = Gtk.IconTheme.get_default().load_icon(
-            icon, 16, 0)
+        icon_vm = qui.icons.load_icon(icon)
         icon_img = Gtk.Image.new_from_pixbuf(icon_vm)
         return icon_img
 
@@ -292,5 +336,5 @@ def device_domain_hbox(vm, attached: bool) -> Gtk.Box:
 
 def create_icon(name) -> Gtk.Image:
     ''' Create an icon from string '''
-    icon_dev = Gtk.IconTheme.get_default().load_icon(name, 16, 0)
+    icon_dev = qui.icons.load_icon(name)
     return Gtk.Image.new_from_pixbuf(icon_dev)
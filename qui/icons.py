@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+''' Process-wide cache of icons loaded from the icon theme.
+
+Widgets show the same few icons (qube labels, actions, device classes) in
+hundreds of menu rows; `load_icon` decodes each of them once and hands out
+the same pixbuf afterwards.
+'''
+# pylint: disable=wrong-import-position,import-error
+import collections
+
+import gi  # isort:skip
+gi.require_version('Gtk', '3.0')  # isort:skip
+from gi.repository import Gtk  # isort:skip
+
+#: maximum number of pixbufs kept in the cache
+CACHE_SIZE = 256
+
+
+class PixbufCache:
+    ''' Bounded LRU cache of pixbufs keyed by (icon name, size). The
+    cache is emptied when the icon theme changes. '''
+
+    def __init__(self, size=CACHE_SIZE, icon_theme=None):
+        self.size = size
+        self.pixbufs = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._icon_theme = icon_theme
+        self._connected = False
+
+    @property
+    def icon_theme(self):
+        # the default theme needs a display, get it only when first needed
+        if self._icon_theme is None:
+            self._icon_theme = Gtk.IconTheme.get_default()
+        if not self._connected:
+            self._icon_theme.connect('changed', self.clear)
+            self._connected = True
+        return self._icon_theme
+
+    def load_icon(self, name, size=16):
+        ''' Returns a pixbuf of the named icon; errors of the icon theme
+        (such as a missing icon) are passed to the caller '''
+        key = (name, size)
+        if key in self.pixbufs:
+            self.pixbufs.move_to_end(key)
+            self.hits += 1
+            return self.pixbufs[key]
+
+        self.misses += 1
+        pixbuf = self.icon_theme.load_icon(name, size, 0)
+        self.pixbufs[key] = pixbuf
+        if len(self.pixbufs) > self.size:
+            self.pixbufs.popitem(last=False)
+        return pixbuf
+
+    def clear(self, *_args):
+        self.pixbufs.clear()
+
+
+ICONS = PixbufCache()
+
+
+def load_icon(name, size=16):
+    ''' Load an icon through the process-wide `PixbufCache` '''
+    return ICONS.load_icon(name, size)
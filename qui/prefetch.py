@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+''' Bulk preloading of domain data for widgets.
+
+Widgets read `klass`, `label`, `template`, `netvm` and power state of
+domains at startup; fetched one at a time, each of them is an Admin API
+round-trip. `preload_domains` fetches them with as few calls as possible: one
+`admin.vm.List`, one `admin.vm.property.GetAll` per domain instead of one call
+per property, and power states from the `admin.vm.List` reply when
+qubesadmin caches them. Properties end up in the qubesadmin property cache,
+power states are returned in a `PreloadedData`.
+
+There is no bulk call for features: listing them and getting those that are
+set takes at least as many calls as getting the wanted ones, so widgets
+read features with `vm.features.get`.
+'''
+# pylint: disable=import-error
+import logging
+
+from qubesadmin import exc
+
+logger = logging.getLogger(__name__)
+
+#: properties read by the domains widget for each domain in its menu
+PROPERTIES = ('label', 'icon', 'template', 'netvm', 'updateable')
+
+
+class PreloadedData:
+    ''' Power states of domains fetched by `preload_domains`, along with call
+    statistics. Getters fall back to qubesd for domains that were not
+    preloaded; exceptions raised by qubesadmin in that case are passed to the
+    caller. '''
+
+    def __init__(self):
+        #: vm name -> power state
+        self.states = {}
+        #: number of Admin API calls issued by the preload
+        self.calls = 0
+        #: number of calls the caller would issue for the same data without
+        #: the preload, fetching it one item at a time
+        self.naive_calls = 0
+
+    @property
+    def saved_calls(self):
+        return self.naive_calls - self.calls
+
+    def get_power_state(self, vm):
+        if vm.name in self.states:
+            return self.states[vm.name]
+        return vm.get_power_state()
+
+    def is_running(self, vm):
+        return self.get_power_state(vm) != 'Halted'
+
+
+class _CallCounter:
+    ''' Counts Admin API calls of `qapp` by wrapping its `qubesd_call`
+    until `restore` is called. Objects of qubesadmin make all their calls
+    through it; calls of app objects without it are not counted. '''
+
+    def __init__(self, qapp):
+        self.qapp = qapp
+        self.count = 0
+        self.wrapped = 'qubesd_call' in vars(qapp)
+        self.qubesd_call = getattr(qapp, 'qubesd_call', None)
+        if self.qubesd_call is not None:
+            qapp.qubesd_call = self.call
+
+    def call(self, *args, **kwargs):
+        self.count += 1
+        return self.qubesd_call(*args, **kwargs)
+
+    def restore(self):
+        if self.qubesd_call is None:
+            return
+        if self.wrapped:
+            self.qapp.qubesd_call = self.qubesd_call
+        else:
+            del self.qapp.qubesd_call
+
+
+def _preload_properties(vm):
+    # pylint: disable=protected-access
+    fetch_all = getattr(vm, '_fetch_all_properties', None)
+    if fetch_all is not None:
+        # fills the property cache; missing in qubesadmin without it
+        fetch_all()
+
+
+def preload_domains(qapp, properties=PROPERTIES, states=True,
+                    domain_filter=None, enable_cache=False):
+    ''' Preload data of all domains in a few bulk Admin API calls.
+
+    Calls are counted by wrapping `qapp.qubesd_call` while preloading;
+    widgets make calls from other threads with Qubes objects of their own.
+    The number of calls saved, compared to fetching the same data one item
+    at a time, is logged.
+
+    :param qapp: `qubesadmin.Qubes` object
+    :param properties: properties the caller reads from each domain chosen
+        by `domain_filter`; they are all fetched at once if there is more
+        than one of them and the property cache stays enabled, otherwise
+        the caller would fetch them again anyway
+    :param states: preload power states
+    :param domain_filter: function of a domain and its preloaded power state
+        (None if not preloaded) choosing domains whose properties the caller
+        reads; by default all
+    :param enable_cache: leave qubesadmin property and power state cache
+        enabled; only pass True if an events dispatcher keeps it current
+    :return: `PreloadedData`
+    '''
+    result = PreloadedData()
+    cache_enabled = getattr(qapp, 'cache_enabled', None)
+    # a single property is not fetched in fewer calls
+    preload_properties = len(properties) > 1 and \
+        cache_enabled is not None and (enable_cache or cache_enabled)
+
+    # listing domains takes one call either way
+    result.naive_calls = 1
+
+    if cache_enabled is not None:
+        qapp.cache_enabled = True
+    counter = _CallCounter(qapp)
+    try:
+        for vm in qapp.domains:
+            state = None
+            if states:
+                calls = counter.count
+                try:
+                    # with the cache enabled, the state comes from the
+                    # admin.vm.List reply
+                    state = vm.get_power_state()
+                    result.states[vm.name] = state
+                except exc.QubesException:
+                    # no permission to access the power state
+                    pass
+                if counter.count > calls or not cache_enabled:
+                    # without the cache, each state is fetched on its own
+                    result.naive_calls += 1
+            if preload_properties and \
+                    (domain_filter is None or domain_filter(vm, state)):
+                calls = counter.count
+                try:
+                    _preload_properties(vm)
+                except exc.QubesException:
+                    # properties not cached are fetched by the caller
+                    # anyway, they are not saved
+                    continue
+                if counter.count > calls:
+                    result.naive_calls += len(properties)
+    finally:
+        counter.restore()
+        result.calls = counter.count
+        if cache_enabled is not None and not enable_cache:
+            qapp.cache_enabled = cache_enabled
+
+    logger.info('Preloaded %d qubes with %d Admin API calls (%d calls '
+                'saved)', len(result.states), result.calls,
+                result.saved_calls)
+    return result
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+import types
+import unittest
+import qui.tray.disk_space as disk_space_widget
+
+
+class PollSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        super(PollSchedulerTest, self).setUp()
+        self.scheduler = disk_space_widget.PollScheduler(
+            min_interval=5, max_interval=600)
+
+    def test_00_interval_shrinks_near_threshold(self):
+        empty = self.scheduler.get_interval(0)
+        half = self.scheduler.get_interval(0.5)
+        close = self.scheduler.get_interval(0.85)
+        self.assertEqual(empty, 600)
+        self.assertGreater(empty, half)
+        self.assertGreater(half, close)
+        self.assertEqual(self.scheduler.get_interval(0.95), 5)
+        self.assertEqual(self.scheduler.get_interval(None), 600)
+
+    def test_01_fast_growth(self):
+        self.scheduler.update('pool', {'data': 0.1}, now=0)
+        self.assertFalse(self.scheduler.is_due('pool', 100))
+        # 0.1 to 0.5 in a minute; the threshold is a minute away
+        self.scheduler.update('pool', {'data': 0.5}, now=60)
+        self.assertTrue(self.scheduler.is_due('pool', 80))
+
+    def test_02_new_target_is_due(self):
+        self.assertTrue(self.scheduler.is_due(('vm', 'private'), 0))
+        self.scheduler.update(('vm', 'private'), {'usage': 0.2}, now=0)
+        self.scheduler.forget(('vm', 'private'))
+        self.assertTrue(self.scheduler.is_due(('vm', 'private'), 0))
+
+    def test_03_full_but_steady(self):
+        self.scheduler.update('pool', {'data': 0.91}, now=0)
+        # growth is not known yet
+        self.assertTrue(self.scheduler.is_due('pool', 5))
+        self.scheduler.update('pool', {'data': 0.91}, now=5)
+        self.assertFalse(self.scheduler.is_due('pool', 60))
+        self.scheduler.update('pool', {'data': 0.92}, now=60)
+        self.assertTrue(self.scheduler.is_due('pool', 65))
+
+    def test_04_failure_backoff(self):
+        intervals = []
+        for _ in range(10):
+            self.scheduler.failed('pool', now=0)
+            intervals.append(self.scheduler.next_poll['pool'])
+        self.assertEqual(intervals[:4], [10, 20, 40, 80])
+        self.assertEqual(intervals[-1], 600)
+        # a successful poll starts over
+        self.scheduler.update('pool', {'data': 0.95}, now=0)
+        self.scheduler.failed('pool', now=0)
+        self.assertEqual(self.scheduler.next_poll['pool'], 10)
+
+
+class UsageHistoryTest(unittest.TestCase):
+    def test_00_not_enough_samples(self):
+        history = disk_space_widget.UsageHistory(size=4)
+        self.assertIsNone(history.get_rate())
+        history.add(0, 0.5)
+        self.assertIsNone(history.get_rate())
+        self.assertIsNone(history.get_time_to_full())
+        # two samples give a rate, but no prediction yet
+        history.add(10, 0.6)
+        self.assertAlmostEqual(history.get_rate(), 0.01)
+        self.assertIsNone(history.get_time_to_full())
+
+    def test_01_linear_growth(self):
+        history = disk_space_widget.UsageHistory(size=4)
+        for i in range(4):
+            history.add(i * 10, 0.1 + i * 0.01)
+        self.assertAlmostEqual(history.get_rate(), 0.001)
+        # 0.13 now, 0.87 left at 0.001 per second
+        self.assertAlmostEqual(history.get_time_to_full(), 870)
+
+    def test_02_ring_buffer(self):
+        history = disk_space_widget.UsageHistory(size=3)
+        for i in range(10):
+            history.add(i, 0.75 if i < 7 else 2 ** (6 - i))
+        self.assertEqual(len(history.times), 3)
+        self.assertEqual(list(history.samples()),
+                         [(7, 0.5), (8, 0.25), (9, 0.125)])
+        self.assertEqual(history.get_last(), 0.125)
+        # usage decreases
+        self.assertIsNone(history.get_time_to_full())
+
+    def test_03_scheduler_prediction(self):
+        scheduler = disk_space_widget.PollScheduler()
+        self.assertIsNone(scheduler.get_time_to_full('pool'))
+        for now in (0, 100, 200):
+            scheduler.update('pool', {'data': 0.5 + now / 1000}, now=now)
+        self.assertAlmostEqual(scheduler.get_time_to_full('pool'), 300)
+        scheduler.forget('pool')
+        self.assertIsNone(scheduler.get_time_to_full('pool'))
+
+    def test_04_separate_series(self):
+        scheduler = disk_space_widget.PollScheduler()
+        # metadata is fuller, but data grows faster; a single series of
+        # the maximum would fit a line through both
+        for now in (0, 100, 200):
+            scheduler.update('pool', {'data': 0.1 + now / 1000,
+                                      'metadata': 0.5 + now / 10000,
+                                      'unknown': None}, now=now)
+        self.assertEqual(set(scheduler.histories['pool']),
+                         {'data', 'metadata'})
+        # data: 0.7 left at 0.001 per second, metadata: 0.48 at 0.0001
+        self.assertAlmostEqual(scheduler.get_time_to_full('pool'), 700)
+
+
+class MockPool:
+    def __init__(self, name, size, usage, metadata_size, metadata_usage):
+        self.name = name
+        self.config = {}
+        self.size = size
+        self.usage = usage
+        self.usage_details = {'metadata_size': metadata_size,
+                              'metadata_usage': metadata_usage}
+
+
+class MockVolume:
+    def __init__(self, size, usage):
+        self.size = size
+        self.usage = usage
+
+
+class QueryTest(unittest.TestCase):
+    def test_00_pool_query(self):
+        pool = MockPool('lvm', 1000, 500, 100, 80)
+        pool_usage = disk_space_widget.PoolUsage(pool)
+        values = pool_usage.query(pool)
+        # the query runs in a worker thread, the main loop applies it
+        self.assertIsNone(pool_usage.size)
+        pool_usage.update(values)
+        self.assertEqual(pool_usage.get_usages(),
+                         {'data': 0.5, 'metadata': 0.8})
+        self.assertFalse(pool_usage.included_in)
+
+    def test_01_volume_query(self):
+        usage = disk_space_widget.VMUsage.query_usage({
+            'private': MockVolume(1000, 250),
+            'root': MockVolume(0, 0)})
+        self.assertEqual(usage, {'private': 0.25})
+
+    def test_02_apply_without_history(self):
+        volume = MockVolume(1000, 500)
+        vm_usage = disk_space_widget.VMUsage(types.SimpleNamespace(name='vm'))
+        widget = types.SimpleNamespace(
+            scheduler=disk_space_widget.PollScheduler())
+        result = (['private'], vm_usage.query_usage({'private': volume}))
+        disk_space_widget.DiskSpace.apply_result(
+            widget, vm_usage, None, result, now=0)
+        # a single sample does not predict anything
+        self.assertEqual(vm_usage.time_to_full, {})
+        self.assertEqual(vm_usage.problem_volumes, {})
+
+        volume.usage = 950
+        disk_space_widget.DiskSpace.apply_result(
+            widget, vm_usage, ['private'],
+            ([], vm_usage.query_usage({'private': volume})), now=10)
+        self.assertEqual(vm_usage.problem_volumes, {'private': 0.95})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,11 +17,13 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library; if not, see <https://www.gnu.org/licenses/>.
 #
+import asyncio
+import threading
 import unittest
 import time
 from gi.repository import Gtk
 import qui.tray.domains as domains_widget
-from qubesadmin import Qubes
+from qubesadmin import Qubes, exc
 
 class DomainsWidgetTest(unittest.TestCase):
 
@@ -105,6 +107,7 @@ class DomainsWidgetTest(unittest.TestCase):
                 self.assertIsNotNone(item,
                                      "domain not listed as started")
                 self.assertIsNotNone(item, "item incorrectly not listed")
+                item.build_submenu()
                 self.assertIsInstance(item.get_submenu(),
                                       domains_widget.StartedMenu,
                                       "incorrect menu (debug not start)")
@@ -128,5 +131,171 @@ class DomainsWidgetTest(unittest.TestCase):
                 Gtk.main_iteration_do(blocking=True)
 
 
+class MockVM:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, name, klass='AppVM', state='Halted'):
+        self.name = name
+        self.klass = klass
+        self.state = state
+        self.features = {}
+        self.calls = 0
+        self.error = None
+
+    def get_power_state(self):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return self.state
+
+    def __str__(self):
+        return self.name
+
+
+class MockDispatcher:
+    def __init__(self):
+        self.handlers = {}
+
+    def add_handler(self, event, handler):
+        self.handlers.setdefault(event, set()).add(handler)
+
+    def remove_handler(self, event, handler):
+        self.handlers[event].discard(handler)
+
+
+class MockQubes:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, vms):
+        self.domains = vms
+
+
+class DomainStateStoreTest(unittest.TestCase):
+    def setUp(self):
+        super(DomainStateStoreTest, self).setUp()
+        self.vms = [MockVM('dom0', 'AdminVM', 'Running'),
+                    MockVM('work', state='Running'),
+                    MockVM('vault')]
+        self.store = domains_widget.DomainStateStore(
+            MockQubes(self.vms), MockDispatcher())
+        self.store.seed()
+
+    def test_00_seed_queries_once(self):
+        for vm in self.vms:
+            self.store.get_state(vm)
+            self.store.get_state(vm)
+            self.assertEqual(vm.calls, 1)
+
+    def test_01_state_from_events(self):
+        work = self.vms[1]
+        changes = []
+        self.store.state_listeners.append(
+            lambda vm, old, new: changes.append((str(vm), old, new)))
+        self.store.on_state_change(work, 'domain-paused')
+        self.assertTrue(self.store.is_paused(work))
+        self.assertEqual(changes, [('work', 'Running', 'Paused')])
+        self.store.on_state_change(work, 'domain-shutdown')
+        self.assertFalse(self.store.is_running(work))
+        self.assertEqual(work.calls, 1)
+
+    def test_02_features_from_events(self):
+        vault = self.vms[2]
+        self.assertFalse(
+            self.store.get_feature(vault, 'updates-available', False))
+        self.store.on_feature_set(vault, 'domain-feature-set:updates-available',
+                                  feature='updates-available', value='1')
+        self.assertEqual(
+            self.store.get_feature(vault, 'updates-available', False), '1')
+        self.store.on_feature_delete(
+            vault, 'domain-feature-delete:updates-available',
+            feature='updates-available')
+        self.assertFalse(
+            self.store.get_feature(vault, 'updates-available', False))
+
+    def test_03_domain_delete(self):
+        self.store.on_domain_delete(None, 'domain-delete', vm='vault')
+        self.assertNotIn('vault', self.store.states)
+
+    def test_04_pause_counters(self):
+        work, vault = self.vms[1], self.vms[2]
+        self.assertEqual(self.store.running_count, 1)
+        self.assertFalse(self.store.have_running_and_all_are_paused())
+        self.store.on_state_change(vault, 'domain-start')
+        self.store.on_state_change(work, 'domain-paused')
+        self.assertFalse(self.store.have_running_and_all_are_paused())
+        self.store.on_state_change(vault, 'domain-paused')
+        self.assertTrue(self.store.have_running_and_all_are_paused())
+        self.store.on_state_change(vault, 'domain-unpaused')
+        self.store.on_state_change(vault, 'domain-shutdown')
+        self.assertTrue(self.store.have_running_and_all_are_paused())
+        self.store.on_state_change(work, 'domain-shutdown')
+        self.assertFalse(self.store.have_running_and_all_are_paused())
+        self.assertEqual(self.store.paused_count, 0)
+        self.assertEqual(self.store.running_count, 0)
+
+    def test_05_state_errors(self):
+        disp = MockVM('disp1234', 'DispVM')
+        disp.error = RuntimeError()
+        self.vms.append(disp)
+        # a fragile DispVM; the guess is not stored
+        self.assertEqual(
+            self.store.get_state(disp, fallback='Transient'), 'Transient')
+        self.assertNotIn('disp1234', self.store.states)
+
+        # the DispVM vanished while its state was being fetched
+        disp.error = exc.QubesVMNotFoundError()
+        self.vms.remove(disp)
+        self.assertIsNone(self.store.get_state(disp))
+        self.assertFalse(self.store.is_running(disp))
+
+
+class MockDomains:
+    def __init__(self, qapp):
+        self.qapp = qapp
+
+    def get_blind(self, name):
+        return MockWorkerVM(self.qapp, name)
+
+
+class MockWorkerVM:
+    # pylint: disable=too-few-public-methods
+    def __init__(self, qapp, name):
+        self.qapp = qapp
+        self.name = name
+
+    def pause(self):
+        self.qapp.paused.append((self.name, threading.get_ident()))
+
+
+class MockWorkerQubes:
+    # pylint: disable=too-few-public-methods
+    instances = []
+
+    def __init__(self):
+        self.domains = MockDomains(self)
+        self.paused = []
+        self.instances.append(self)
+
+
+class ActionExecutorTest(unittest.TestCase):
+    def test_00_worker_qapp(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        executor = domains_widget.ActionExecutor(
+            loop, concurrency=2, qapp_factory=MockWorkerQubes)
+        vm = MockVM('work', state='Running')
+
+        future = executor.submit(vm, 'pause')
+        # duplicate requests are not started again
+        self.assertIs(executor.submit(vm, 'pause'), future)
+        loop.run_until_complete(future)
+
+        # the call was made on an object of the worker's own Qubes
+        self.assertEqual(len(MockWorkerQubes.instances), 1)
+        qapp = MockWorkerQubes.instances[0]
+        self.assertEqual(len(qapp.paused), 1)
+        self.assertEqual(qapp.paused[0][0], 'work')
+        self.assertNotEqual(qapp.paused[0][1], threading.get_ident())
+        self.assertEqual(executor.in_flight, {})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+import unittest
+import qui.icons
+
+
+class MockIconTheme:
+    def __init__(self):
+        self.loaded = []
+        self.handlers = []
+
+    def connect(self, signal, handler):
+        self.handlers.append((signal, handler))
+
+    def load_icon(self, name, size, _flags):
+        self.loaded.append((name, size))
+        return object()
+
+    def change(self):
+        for signal, handler in self.handlers:
+            if signal == 'changed':
+                handler(self)
+
+
+class PixbufCacheTest(unittest.TestCase):
+    def setUp(self):
+        super(PixbufCacheTest, self).setUp()
+        self.theme = MockIconTheme()
+        self.cache = qui.icons.PixbufCache(size=2, icon_theme=self.theme)
+
+    def test_00_cached(self):
+        pixbuf = self.cache.load_icon('red')
+        self.assertIs(self.cache.load_icon('red'), pixbuf)
+        self.assertIsNot(self.cache.load_icon('red', 24), pixbuf)
+        self.assertEqual(self.theme.loaded, [('red', 16), ('red', 24)])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_01_lru(self):
+        self.cache.load_icon('red')
+        self.cache.load_icon('green')
+        self.cache.load_icon('red')
+        # green is the least recently used
+        self.cache.load_icon('blue')
+        self.assertEqual(list(self.cache.pixbufs),
+                         [('red', 16), ('blue', 16)])
+
+    def test_02_theme_changed(self):
+        self.cache.load_icon('red')
+        self.theme.change()
+        self.cache.load_icon('red')
+        self.assertEqual(self.theme.loaded, [('red', 16), ('red', 16)])
+
+
+if __name__ == "__main__":
+    unittest.main()
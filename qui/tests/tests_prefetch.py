@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+#
+# The Qubes OS Project, https://www.qubes-os.org/
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, see <https://www.gnu.org/licenses/>.
+#
+import unittest
+import qui.prefetch
+
+
+class MockVM:
+    def __init__(self, app, name, state):
+        self.app = app
+        self.name = name
+        self.state = state
+
+    def get_power_state(self):
+        # like qubesadmin, states from admin.vm.List are used if cached
+        cached = getattr(self, '_power_state_cache', None)
+        if self.app.cache_enabled and cached is not None:
+            return cached
+        self.app.qubesd_call(self.name, 'admin.vm.CurrentState')
+        return self.state
+
+    def _fetch_all_properties(self):
+        self.app.qubesd_call(self.name, 'admin.vm.property.GetAll')
+
+
+class MockDomains(list):
+    def __init__(self, app, domains):
+        super().__init__(domains)
+        self.app = app
+
+    def __iter__(self):
+        self.app.qubesd_call('dom0', 'admin.vm.List')
+        return super().__iter__()
+
+
+class MockQubes:
+    def __init__(self):
+        self.calls = []
+        self.cache_enabled = False
+        self.domains = MockDomains(self, [
+            MockVM(self, 'dom0', 'Running'),
+            MockVM(self, 'fedora', 'Halted'),
+            MockVM(self, 'work', 'Running'),
+        ])
+
+    def qubesd_call(self, dest, method):
+        self.calls.append((dest, method))
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_00_preload(self):
+        qapp = MockQubes()
+        preloaded = qui.prefetch.preload_domains(qapp, enable_cache=True)
+
+        self.assertEqual(preloaded.calls, len(qapp.calls))
+        # list, and per domain a state and each property
+        self.assertEqual(preloaded.naive_calls,
+                         1 + 3 * (1 + len(qui.prefetch.PROPERTIES)))
+        self.assertEqual(preloaded.saved_calls,
+                         3 * (len(qui.prefetch.PROPERTIES) - 1))
+        self.assertNotIn('qubesd_call', vars(qapp))
+        self.assertTrue(qapp.cache_enabled)
+        self.assertEqual(preloaded.states['work'], 'Running')
+        self.assertTrue(preloaded.is_running(qapp.domains[0]))
+        self.assertFalse(preloaded.is_running(qapp.domains[1]))
+
+        # preloaded states do not need any further calls
+        calls = len(qapp.calls)
+        preloaded.get_power_state(qapp.domains[2])
+        self.assertEqual(len(qapp.calls), calls)
+
+    def test_01_preload_selected(self):
+        qapp = MockQubes()
+        preloaded = qui.prefetch.preload_domains(
+            qapp, properties=('label', 'netvm'), states=False,
+            domain_filter=lambda vm, state: vm.name == 'fedora',
+            enable_cache=True)
+
+        self.assertEqual(preloaded.calls, len(qapp.calls))
+        # power states are neither fetched nor counted as saved
+        self.assertNotIn(('work', 'admin.vm.CurrentState'), qapp.calls)
+        self.assertEqual(preloaded.states, {})
+        self.assertEqual(preloaded.naive_calls, 1 + 2)
+        self.assertEqual(
+            [call for call in qapp.calls
+             if call[1] == 'admin.vm.property.GetAll'],
+            [('fedora', 'admin.vm.property.GetAll')])
+
+    def test_02_filter_by_state(self):
+        qapp = MockQubes()
+        qui.prefetch.preload_domains(
+            qapp, domain_filter=lambda vm, state: state != 'Halted',
+            enable_cache=True)
+
+        self.assertIn(('work', 'admin.vm.property.GetAll'), qapp.calls)
+        self.assertNotIn(('fedora', 'admin.vm.property.GetAll'), qapp.calls)
+
+    def test_03_no_useless_properties(self):
+        qapp = MockQubes()
+        # a single property is not fetched in fewer calls
+        preloaded = qui.prefetch.preload_domains(
+            qapp, properties=('template',), states=False, enable_cache=True)
+        self.assertEqual(qapp.calls, [('dom0', 'admin.vm.List')])
+        self.assertEqual(preloaded.saved_calls, 0)
+
+        # without the cache, the caller would fetch properties again
+        qapp.cache_enabled = False
+        qapp.calls.clear()
+        preloaded = qui.prefetch.preload_domains(qapp, states=False)
+        self.assertEqual(qapp.calls, [('dom0', 'admin.vm.List')])
+        self.assertEqual(preloaded.saved_calls, 0)
+
+    def test_04_cached_power_state(self):
+        qapp = MockQubes()
+        for vm in qapp.domains:
+            vm._power_state_cache = vm.state
+        qapp.calls.clear()
+        preloaded = qui.prefetch.preload_domains(qapp, properties=())
+
+        self.assertEqual(qapp.calls, [('dom0', 'admin.vm.List')])
+        self.assertEqual(preloaded.calls, 1)
+        self.assertEqual(preloaded.naive_calls, 1 + 3)
+        self.assertEqual(preloaded.states['fedora'], 'Halted')
+        self.assertFalse(qapp.cache_enabled)
+
+        # with the cache already enabled, states come at no cost either way
+        qapp.cache_enabled = True
+        preloaded = qui.prefetch.preload_domains(qapp, properties=())
+        self.assertEqual(preloaded.saved_calls, 0)
+        self.assertTrue(qapp.cache_enabled)
+
+    def test_05_uncached_power_state(self):
+        qapp = MockQubes()
+        preloaded = qui.prefetch.preload_domains(qapp, properties=())
+
+        # each state takes a call either way
+        self.assertEqual(preloaded.calls, 1 + 3)
+        self.assertEqual(preloaded.saved_calls, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
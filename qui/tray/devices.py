@@ -1,23 +1,31 @@
 # pylint: disable=wrong-import-position,import-error
 import asyncio
+import bisect
+import concurrent.futures
+import logging
 import sys
+import threading
+import time
 
 import traceback
 
 import gi
 gi.require_version('Gtk', '3.0')  # isort:skip
 gi.require_version('AppIndicator3', '0.1')  # isort:skip
-from gi.repository import Gtk, Gio  # isort:skip
+from gi.repository import Gtk, Gio, GLib  # isort:skip
 
 import qubesadmin
 import qubesadmin.events
 import qubesadmin.devices
 import qubesadmin.exc
 import qui.decorators
+import qui.prefetch
 
 import gbulb
 gbulb.install()
 
+logger = logging.getLogger(__name__)
+
 
 import gettext
 t = gettext.translation("desktop-linux-manager", localedir="/usr/locales",
@@ -31,6 +39,13 @@ DEV_TYPE_NAMES = {
     'mic': 'Audio Input'
 }
 
+# number of domains whose devices are listed at the same time at startup
+ENUMERATION_CONCURRENCY = 8
+
+# device add/remove notifications of a backend within this time (in ms) are
+# merged into one
+NOTIFICATION_DELAY = 1000
+
 
 class DomainMenuItem(Gtk.ImageMenuItem):
     """ A submenu item for the device menu. Displays attachment status.
@@ -43,31 +58,75 @@ class DomainMenuItem(Gtk.ImageMenuItem):
 
         self.device = device
 
-        # if we cannot access vm icon, show default appvm-black
-        icon = getattr(self.vm, 'icon', 'appvm-black')
+        self._hbox = None
+        self._attached = None
 
-        self.set_image(qui.decorators.create_icon(icon))
-        self._hbox = qui.decorators.device_domain_hbox(self.vm, self.attached)
-        self.add(self._hbox)
+        self.update_icon()
+        self.update_attachment()
 
     @property
     def attached(self):
         return str(self.vm) in self.device.attachments
 
+    def update_icon(self):
+        # if we cannot access vm icon, show default appvm-black
+        icon = getattr(self.vm, 'icon', 'appvm-black')
+
+        self.set_image(qui.decorators.create_icon(icon))
+
+    def update_attachment(self):
+        attached = self.attached
+        if attached == self._attached:
+            return
+        self._attached = attached
+        if self._hbox:
+            self.remove(self._hbox)
+        self._hbox = qui.decorators.device_domain_hbox(self.vm, attached)
+        self.add(self._hbox)
+        self._hbox.show_all()
+
 
 class DomainMenu(Gtk.Menu):
     def __init__(self, device, domains, qapp, gtk_app, **kwargs):
         super(DomainMenu, self).__init__(**kwargs)
         self.device = device
-        self.domains = domains
         self.qapp = qapp
         self.gtk_app = gtk_app
 
-        for vm in self.domains:
-            if vm != device.backend_domain:
-                menu_item = DomainMenuItem(self.device, vm)
-                menu_item.connect('activate', self.toggle)
-                self.append(menu_item)
+        # vm name -> DomainMenuItem, and sorted names matching menu order
+        self.menu_items = {}
+        self.vm_names = []
+
+        for vm in domains:
+            self.add_vm(vm)
+
+    def add_vm(self, vm):
+        name = str(vm)
+        if name == self.device.backend_domain or name in self.menu_items:
+            return
+        menu_item = DomainMenuItem(self.device, vm)
+        menu_item.connect('activate', self.toggle)
+        position = bisect.bisect_left(self.vm_names, name)
+        self.vm_names.insert(position, name)
+        self.menu_items[name] = menu_item
+        self.insert(menu_item, position)
+        menu_item.show_all()
+
+    def remove_vm(self, vm):
+        name = str(vm)
+        menu_item = self.menu_items.pop(name, None)
+        if menu_item is None:
+            return
+        del self.vm_names[bisect.bisect_left(self.vm_names, name)]
+        self.remove(menu_item)
+
+    def update_attachments(self):
+        for menu_item in self.menu_items.values():
+            menu_item.update_attachment()
+
+    def update_vm_icon(self, vm_name):
+        if vm_name in self.menu_items:
+            self.menu_items[vm_name].update_icon()
 
     def toggle(self, menu_item):
         if menu_item.attached:
@@ -88,32 +147,32 @@ class DomainMenu(Gtk.Menu):
             vm_to_attach = self.qapp.domains[str(menu_item.vm)]
             vm_to_attach.devices[menu_item.device.devclass].attach(assignment)
 
-            self.gtk_app.emit_notification(
+            self.gtk_app.notifier.emit_device_notification(
+                self.device,
                 _("Attaching device"),
                 _("Attaching {} to {}").format(self.device.description,
                                                menu_item.vm),
-                Gio.NotificationPriority.NORMAL,
-                notification_id=self.device.backend_domain + self.device.ident)
+                Gio.NotificationPriority.NORMAL)
         except Exception as ex:  # pylint: disable=broad-except
-            self.gtk_app.emit_notification(
+            self.gtk_app.notifier.emit_device_notification(
+                self.device,
                 _("Error"),
                 _("Attaching device {0} to {1} failed. "
                   "Error: {2} - {3}").format(
                     self.device.description, menu_item.vm, type(ex).__name__,
                     ex),
                 Gio.NotificationPriority.HIGH,
-                error=True,
-                notification_id=self.device.backend_domain + self.device.ident)
-            self.update_dev_attachments()
+                error=True)
+            self.update_dev_attachments(str(menu_item.vm))
             traceback.print_exc(file=sys.stderr)
 
     def detach_item(self):
-        for vm in self.device.attachments:
-            self.gtk_app.emit_notification(
+        for vm in list(self.device.attachments):
+            self.gtk_app.notifier.emit_device_notification(
+                self.device,
                 _("Detaching device"),
                 _("Detaching {} from {}").format(self.device.description, vm),
-                Gio.NotificationPriority.NORMAL,
-                notification_id=self.device.backend_domain + self.device.ident)
+                Gio.NotificationPriority.NORMAL)
             try:
                 assignment = qubesadmin.devices.DeviceAssignment(
                     self.device.backend_domain, self.device.ident,
@@ -121,45 +180,68 @@ class DomainMenu(Gtk.Menu):
                 self.qapp.domains[vm].devices[self.device.devclass].detach(
                     assignment)
             except qubesadmin.exc.QubesException as ex:
-                self.gtk_app.emit_notification(
+                self.gtk_app.notifier.emit_device_notification(
+                    self.device,
                     _("Error"),
                     _("Detaching device {0} from {1} failed. "
                       "Error: {2}").format(self.device.description, vm, ex),
                     Gio.NotificationPriority.HIGH,
-                    error=True,
-                    notification_id=(self.device.backend_domain +
-                                     self.device.ident))
-                self.update_dev_attachments()
+                    error=True)
+                self.update_dev_attachments(vm)
                 return False
         return True
 
-    def update_dev_attachments(self):
+    def update_dev_attachments(self, vm_name):
         # use this only in cases of error, when there is a reason
         # to suspect the correct detach/attach events were not fired
-        self.device.attachments = set()
-
-        for vm in self.qapp.domains:
-            try:
-                for device in vm.devices[self.device.devclass].attached():
-                    if str(device) == self.device.dev_name:
-                        self.device.attachments.add(vm.name)
-            except qubesadmin.exc.QubesDaemonAccessError:
-                continue
+        self.gtk_app.reconcile_attachments(self.device, [vm_name])
 
 
 class DeviceItem(Gtk.ImageMenuItem):
-    """ MenuItem showing the device data and a :class:`DomainMenu`. """
+    """ MenuItem showing the device data and a :class:`DomainMenu`. The
+    domain menu is created when the item is first selected and then kept
+    up to date by the tray. """
 
-    def __init__(self, device, *args, **kwargs):
+    def __init__(self, device, gtk_app, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self.device = device
+        self.gtk_app = gtk_app
+
+        self.hbox = None  # type: Gtk.Box
 
-        self.hbox = qui.decorators.device_hbox(self.device)  # type: Gtk.Box
+        self.update_icon()
+        self.update_attachments()
 
+        # empty placeholder, so that the submenu indicator is shown
+        self.set_submenu(Gtk.Menu())
+
+    @property
+    def domain_menu(self):
+        submenu = self.get_submenu()
+        if isinstance(submenu, DomainMenu):
+            return submenu
+        return None
+
+    def do_select(self):  # pylint: disable=arguments-differ
+        if self.domain_menu is None:
+            domain_menu = DomainMenu(self.device, sorted(self.gtk_app.vms),
+                                     self.gtk_app.qapp, self.gtk_app)
+            self.set_submenu(domain_menu)
+        Gtk.ImageMenuItem.do_select(self)
+
+    def update_icon(self):
         self.set_image(qui.decorators.create_icon(self.device.vm_icon))
 
+    def update_attachments(self):
+        if self.hbox:
+            self.remove(self.hbox)
+        self.hbox = qui.decorators.device_hbox(self.device)
         self.add(self.hbox)
+        self.hbox.show_all()
+
+        if self.domain_menu:
+            self.domain_menu.update_attachments()
 
 
 class DevclassHeaderMenuItem(Gtk.MenuItem):
@@ -222,22 +304,174 @@ class VM:
         return self.__hash
 
 
+class DeviceNotifier:
+    """ Notifications about devices of the tray. Devices added and removed
+    shortly after each other are announced together, per backend domain;
+    a later notification about one of them takes it out of the
+    announcement. """
+    def __init__(self, gtk_app):
+        self.gtk_app = gtk_app
+        # backend domain name -> (added, removed) devices not notified yet
+        self.pending = {}
+        # device name -> id of the notification that announced the device
+        self.ids = {}
+        # id of a notification announcing several devices -> (backend
+        # domain name, added devices, removed devices) it lists
+        self.announcements = {}
+
+    def queue(self, dev, added):
+        """ Queue a notification that the device was added or removed. A
+        device added and removed again, or the other way round, within the
+        same NOTIFICATION_DELAY is not announced at all. """
+        if not self.pending:
+            GLib.timeout_add(NOTIFICATION_DELAY, self.flush)
+        added_devices, removed_devices = self.pending.setdefault(
+            dev.backend_domain, ([], []))
+        if added:
+            queued, other = added_devices, removed_devices
+        else:
+            queued, other = removed_devices, added_devices
+        if dev in other:
+            other.remove(dev)
+        else:
+            queued.append(dev)
+
+    def flush(self):
+        """ Send one notification per backend about devices queued by
+        `queue` """
+        for backend, (added, removed) in sorted(self.pending.items()):
+            if not added and not removed:
+                # only changes that cancelled out
+                continue
+            if len(added) + len(removed) == 1:
+                dev = (added + removed)[0]
+                notification_id = self.get_notification_id(dev)
+                if added:
+                    title = _("Device available")
+                    message = _("Device {} is available").format(
+                        dev.description)
+                else:
+                    title = _("Device removed")
+                    message = _("Device {} is removed").format(
+                        dev.description)
+                self.emit_notification(title, message,
+                                       Gio.NotificationPriority.NORMAL,
+                                       notification_id=notification_id)
+            else:
+                notification_id = backend + ':devices'
+                self.emit_announcement(notification_id, backend, added,
+                                       removed)
+            for dev in added + removed:
+                self.forget_announcement(dev, notification_id)
+            for dev in added:
+                self.ids[str(dev)] = notification_id
+
+        self.pending.clear()
+        return False
+
+    def emit_announcement(self, notification_id, backend, added, removed):
+        """ Notification about several devices of a backend """
+        title = _("Devices changed in {}").format(backend)
+        lines = []
+        if added:
+            lines.append(_("Available: {}").format(
+                ", ".join(dev.description for dev in added)))
+        if removed:
+            lines.append(_("Removed: {}").format(
+                ", ".join(dev.description for dev in removed)))
+        self.emit_notification(title, "\n".join(lines),
+                               Gio.NotificationPriority.NORMAL,
+                               notification_id=notification_id)
+        self.announcements[notification_id] = (backend, added, removed)
+
+    def forget_announcement(self, dev, notification_id):
+        """ Remove the device from the notification that announced it, if
+        that is another notification than `notification_id`, listing other
+        devices too. It is sent again without the device, or withdrawn if
+        no devices are left. """
+        announcement_id = self.ids.pop(str(dev), None)
+        if announcement_id in (None, notification_id) or \
+                announcement_id not in self.announcements:
+            return
+        backend, added, removed = self.announcements[announcement_id]
+        if dev not in added + removed:
+            # replaced by a later announcement of the backend
+            return
+        del self.announcements[announcement_id]
+        added = [other for other in added if other != dev]
+        removed = [other for other in removed if other != dev]
+        if added or removed:
+            self.emit_announcement(announcement_id, backend, added, removed)
+        else:
+            self.gtk_app.withdraw_notification(announcement_id)
+
+    @staticmethod
+    def get_notification_id(dev):
+        """ Id of notifications about the device, so that a new one replaces
+        the last one, including errors """
+        return dev.backend_domain + dev.ident
+
+    def emit_device_notification(self, dev, title, message, priority,
+                                 error=False):
+        """ Notification about the device. If the device was announced
+        together with other devices, it is removed from that announcement,
+        as it is out of date now """
+        notification_id = self.get_notification_id(dev)
+        self.forget_announcement(dev, notification_id)
+        self.emit_notification(title, message, priority, error=error,
+                               notification_id=notification_id)
+
+    def emit_notification(self, title, message, priority, error=False,
+                          notification_id=None):
+        notification = Gio.Notification.new(title)
+        notification.set_body(message)
+        notification.set_priority(priority)
+        if error:
+            notification.set_icon(Gio.ThemedIcon.new('dialog-error'))
+        self.gtk_app.send_notification(notification_id, notification)
+
+
 class DevicesTray(Gtk.Application):
-    def __init__(self, app_name, qapp, dispatcher):
+    def __init__(self, app_name, qapp, dispatcher,
+                 qapp_factory=qubesadmin.Qubes):
         super(DevicesTray, self).__init__()
         self.name = app_name
 
+        # qubesadmin objects are not thread-safe; worker threads listing
+        # devices at startup make their own with qapp_factory
+        self.qapp_factory = qapp_factory
+        self.local = threading.local()
+
         self.devices = {}
+        # (backend domain name, devclass) -> names of devices
+        self.backend_devices = {}
+        # vm name -> names of devices attached to it, the reverse of
+        # Device.attachments
+        self.vm_attachments = {}
+
+        self.notifier = DeviceNotifier(self)
         self.vms = set()
 
+        # the menu is kept for the lifetime of the tray and updated from
+        # events; items are sorted by (devclass, device name), with a header
+        # keyed (devclass, '') in front of each devclass
+        self.tray_menu = Gtk.Menu()
+        self.menu_items = {}
+        self.menu_keys = []
+
         self.dispatcher = dispatcher
         self.qapp = qapp
 
         self.set_application_id(self.name)
         self.register()  # register Gtk Application
 
-        self.initialize_vm_data()
-        self.initialize_dev_data()
+        # only power states are read for all domains, labels just for
+        # menus that are opened
+        preloaded = qui.prefetch.preload_domains(self.qapp, properties=())
+
+        self.initialize_vm_data(preloaded)
+        self.initialize_dev_data(preloaded)
+        self.initialize_menu()
 
         for devclass in DEV_TYPES:
             self.dispatcher.add_handler('device-attach:' + devclass,
@@ -260,75 +494,183 @@ class DevicesTray(Gtk.Application):
         self.widget_icon.set_tooltip_markup(
             _('<b>Qubes Devices</b>\nView and manage devices.'))
 
-    def device_list_update(self, vm, _event, **_kwargs):
+    def device_list_update(self, vm, event, **_kwargs):
+        # the event is device-list-change:<devclass>, only that devclass
+        # has changed
+        devclass = event.split(':', 1)[1]
 
-        changed_devices = []
+        current_devices = {}
 
-        # create list of all current devices from the changed VM
+        # list all current devices of the changed VM
         try:
-            for devclass in DEV_TYPES:
-                for device in vm.devices[devclass]:
-                    changed_devices.append(Device(device))
+            for device in vm.devices[devclass]:
+                current_devices[str(device)] = device
         except qubesadmin.exc.QubesException:
-            changed_devices = []  # VM was removed
-
-        for dev in changed_devices:
-            if str(dev) not in self.devices:
-                self.devices[str(dev)] = dev
-                self.emit_notification(
-                    _("Device available"),
-                    _("Device {} is available").format(dev.description),
-                    Gio.NotificationPriority.NORMAL,
-                    notification_id=(dev.backend_domain +
-                                     dev.ident))
-
-        dev_to_remove = [name for name, dev in self.devices.items()
-                         if dev.backend_domain == vm
-                         and name not in changed_devices]
-        for dev_name in dev_to_remove:
-            self.emit_notification(
-                _("Device removed"),
-                _("Device {} is removed").format(
-                    self.devices[dev_name].description),
-                Gio.NotificationPriority.NORMAL,
-                notification_id=(self.devices[dev_name].backend_domain +
-                                 self.devices[dev_name].ident))
-            del self.devices[dev_name]
-
-    def initialize_vm_data(self):
+            current_devices = {}  # VM was removed
+
+        known_devices = self.backend_devices.get((str(vm), devclass), set())
+
+        for dev_name in sorted(current_devices.keys() - known_devices):
+            dev = Device(current_devices[dev_name])
+            self.add_device(dev)
+            self.notifier.queue(dev, added=True)
+
+        for dev_name in sorted(known_devices - current_devices.keys()):
+            self.notifier.queue(self.devices[dev_name], added=False)
+            self.remove_device(dev_name)
+
+    def add_device(self, dev):
+        self.devices[str(dev)] = dev
+        self.backend_devices.setdefault(
+            (dev.backend_domain, dev.devclass), set()).add(str(dev))
+
+        header_key = (dev.devclass, '')
+        if header_key not in self.menu_items:
+            self._insert_menu_item(header_key,
+                                   DevclassHeaderMenuItem(dev.devclass))
+        self._insert_menu_item((dev.devclass, str(dev)), DeviceItem(dev, self))
+
+    def remove_device(self, dev_name):
+        dev = self.devices.pop(dev_name)
+        for vm_name in dev.attachments:
+            self._forget_attachment(dev_name, vm_name)
+        key = (dev.backend_domain, dev.devclass)
+        self.backend_devices[key].discard(dev_name)
+        if not self.backend_devices[key]:
+            del self.backend_devices[key]
+
+        position = self._remove_menu_item((dev.devclass, dev_name))
+        # remove the header if this was the last device of its class
+        if position == len(self.menu_keys) or \
+                self.menu_keys[position][0] != dev.devclass:
+            if self.menu_keys[position - 1] == (dev.devclass, ''):
+                self._remove_menu_item((dev.devclass, ''))
+
+    def _insert_menu_item(self, key, menu_item):
+        position = bisect.bisect_left(self.menu_keys, key)
+        self.menu_keys.insert(position, key)
+        self.menu_items[key] = menu_item
+        self.tray_menu.insert(menu_item, position)
+        menu_item.show_all()
+
+    def _remove_menu_item(self, key):
+        position = bisect.bisect_left(self.menu_keys, key)
+        del self.menu_keys[position]
+        self.tray_menu.remove(self.menu_items.pop(key))
+        return position
+
+    def get_device_item(self, dev):
+        return self.menu_items.get((dev.devclass, str(dev)))
+
+    def get_device_items(self):
+        for key, menu_item in self.menu_items.items():
+            if key[1]:
+                yield menu_item
+
+    def add_attachment(self, dev, vm_name):
+        dev.attachments.add(vm_name)
+        self.vm_attachments.setdefault(vm_name, set()).add(str(dev))
+        self.update_device_item(dev)
+
+    def remove_attachment(self, dev, vm_name):
+        dev.attachments.discard(vm_name)
+        self._forget_attachment(str(dev), vm_name)
+        self.update_device_item(dev)
+
+    def _forget_attachment(self, dev_name, vm_name):
+        attached = self.vm_attachments.get(vm_name)
+        if attached is not None:
+            attached.discard(dev_name)
+            if not attached:
+                del self.vm_attachments[vm_name]
+
+    def reconcile_attachments(self, dev, vm_names=()):
+        """ Query attachments of a single device from qubesd. Only qubes the
+        device is believed to be attached to and `vm_names` are asked. """
+        for vm_name in dev.attachments | set(vm_names):
+            try:
+                attached = any(
+                    str(device) == str(dev) for device in
+                    self.qapp.domains[vm_name].devices[dev.devclass].attached())
+            except (KeyError, qubesadmin.exc.QubesException):
+                attached = False
+            if attached:
+                self.add_attachment(dev, vm_name)
+            else:
+                self.remove_attachment(dev, vm_name)
+
+    def update_device_item(self, dev):
+        menu_item = self.get_device_item(dev)
+        if menu_item:
+            menu_item.update_attachments()
+
+    def initialize_vm_data(self, preloaded):
         for vm in self.qapp.domains:
             try:
-                if vm.klass != 'AdminVM' and vm.is_running():
+                if vm.klass != 'AdminVM' and preloaded.is_running(vm):
                     self.vms.add(VM(vm))
             except qubesadmin.exc.QubesException:
                 # we don't have access to VM state
                 pass
 
-    def initialize_dev_data(self):
+    def initialize_dev_data(self, preloaded):
+        # halted domains neither provide devices nor have any attached
+        domains = []
+        for domain in self.qapp.domains:
+            try:
+                if preloaded.is_running(domain):
+                    domains.append(domain)
+            except qubesadmin.exc.QubesException:
+                # we don't have access to VM state
+                continue
+
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=ENUMERATION_CONCURRENCY) as executor:
+            results = list(executor.map(
+                self.list_domain_devices, [domain.name for domain in domains]))
+        logger.info('Listed devices of %d qubes in %.3f seconds',
+                    len(domains), time.monotonic() - start)
 
         # list all devices
-        for domain in self.qapp.domains:
-            for devclass in DEV_TYPES:
-                try:
-                    for device in domain.devices[devclass]:
-                        self.devices[str(device)] = Device(device)
-                except qubesadmin.exc.QubesException:
-                    # we have no permission to access VM's devices
-                    continue
+        for devices, _attached in results:
+            for dev in devices:
+                self.devices[str(dev)] = dev
 
         # list existing device attachments
-        for domain in self.qapp.domains:
-            for devclass in DEV_TYPES:
-                try:
-                    for device in domain.devices[devclass].attached():
-                        dev = str(device)
-                        if dev in self.devices:
-                            # occassionally ghost UnknownDevices appear when a
-                            # device was removed but not detached from a VM
-                            self.devices[dev].attachments.add(domain.name)
-                except qubesadmin.exc.QubesException:
-                    # we have no permission to access VM's devices
-                    continue
+        for domain, (_devices, attached) in zip(domains, results):
+            for dev in attached:
+                if dev in self.devices:
+                    # occassionally ghost UnknownDevices appear when a
+                    # device was removed but not detached from a VM
+                    self.add_attachment(self.devices[dev], domain.name)
+
+    def list_domain_devices(self, vm_name):
+        """ Devices provided by a domain and names of devices attached to it,
+        of all DEV_TYPES. Runs in a worker thread, which looks the domain up
+        in a Qubes object of its own; the results only hold names. """
+        qapp = getattr(self.local, 'qapp', None)
+        if qapp is None:
+            qapp = self.local.qapp = self.qapp_factory()
+        domain = qapp.domains.get_blind(vm_name)
+        devices = []
+        attached = []
+        for devclass in DEV_TYPES:
+            try:
+                for device in domain.devices[devclass]:
+                    devices.append(Device(device))
+                for device in domain.devices[devclass].attached():
+                    attached.append(str(device))
+            except qubesadmin.exc.QubesException:
+                # we have no permission to access VM's devices
+                continue
+        return devices, attached
+
+    def initialize_menu(self):
+        devices = list(self.devices.values())
+        self.devices.clear()
+        for dev in devices:
+            self.add_device(dev)
 
     def device_attached(self, vm, _event, device, **_kwargs):
         try:
@@ -339,9 +681,9 @@ class DevicesTray(Gtk.Application):
             return
 
         if str(device) not in self.devices:
-            self.devices[str(device)] = Device(device)
+            self.add_device(Device(device))
 
-        self.devices[str(device)].attachments.add(str(vm))
+        self.add_attachment(self.devices[str(device)], str(vm))
 
     def device_detached(self, vm, _event, device, **_kwargs):
         try:
@@ -354,25 +696,36 @@ class DevicesTray(Gtk.Application):
         device = str(device)
 
         if device in self.devices:
-            self.devices[device].attachments.discard(str(vm))
+            self.remove_attachment(self.devices[device], str(vm))
 
     def vm_start(self, vm, _event, **_kwargs):
-        self.vms.add(VM(vm))
+        domain = VM(vm)
+        self.vms.add(domain)
+        for menu_item in self.get_device_items():
+            if menu_item.domain_menu:
+                menu_item.domain_menu.add_vm(domain)
+
         for devclass in DEV_TYPES:
             try:
                 for device in vm.devices[devclass].attached():
                     dev = str(device)
                     if dev in self.devices:
-                        self.devices[dev].attachments.add(vm.name)
+                        self.add_attachment(self.devices[dev], vm.name)
             except qubesadmin.exc.QubesDaemonAccessError:
                 # we don't have access to devices
                 return
 
     def vm_shutdown(self, vm, _event, **_kwargs):
         self.vms.discard(vm)
+        for menu_item in self.get_device_items():
+            if menu_item.domain_menu:
+                menu_item.domain_menu.remove_vm(vm)
 
-        for dev in self.devices.values():
+        # only devices attached to this VM are affected
+        for dev_name in self.vm_attachments.pop(str(vm), set()):
+            dev = self.devices[dev_name]
             dev.attachments.discard(str(vm))
+            self.update_device_item(dev)
 
     def on_label_changed(self, vm, _event, **_kwargs):
         if not vm:  # global properties changed
@@ -388,62 +741,43 @@ class DevicesTray(Gtk.Application):
                 except qubesadmin.exc.QubesPropertyAccessError:
                     domain.icon = 'appvm-block'
 
-        for device in self.devices.values():
+        for menu_item in self.get_device_items():
+            device = menu_item.device
             if device.backend_domain == name:
                 try:
                     device.vm_icon = vm.label.icon
                 except qubesadmin.exc.QubesPropertyAccessError:
                     device.vm_icon = 'appvm-black'
+                menu_item.update_icon()
+            if menu_item.domain_menu:
+                menu_item.domain_menu.update_vm_icon(name)
 
     def show_menu(self, _unused, _event):
-        tray_menu = Gtk.Menu()
-
-        # create menu items
-        menu_items = []
-        sorted_vms = sorted(self.vms)
-        for dev in self.devices.values():
-            domain_menu = DomainMenu(dev, sorted_vms, self.qapp, self)
-            device_menu = DeviceItem(dev)
-            device_menu.set_submenu(domain_menu)
-            menu_items.append(device_menu)
-
-        menu_items.sort(key=(lambda x: x.device.devclass + str(x.device)))
-
-        if menu_items:
-            tray_menu.add(DevclassHeaderMenuItem(menu_items[0].device.devclass))
-
-        for i, item in enumerate(menu_items):
-            if i > 0 and item.device.devclass != \
-                    menu_items[i-1].device.devclass:
-                tray_menu.add(
-                    DevclassHeaderMenuItem(menu_items[i].device.devclass))
-            tray_menu.add(item)
+        self.tray_menu.popup_at_pointer(None)  # use current event
 
-        tray_menu.show_all()
-        tray_menu.popup_at_pointer(None)  # use current event
 
-    def emit_notification(self, title, message, priority, error=False,
-                          notification_id=None):
-        notification = Gio.Notification.new(title)
-        notification.set_body(message)
-        notification.set_priority(priority)
-        if error:
-            notification.set_icon(Gio.ThemedIcon.new('dialog-error'))
-            if notification_id:
-                notification_id += 'ERROR'
-        self.send_notification(notification_id, notification)
+def load_widget(qapp, dispatcher, qapp_factory=qubesadmin.Qubes):
+    ''' Create the widget for `qui.tray.host`; returns the application and
+    coroutines that have to run along with the events dispatcher.
+    `qapp_factory` makes Qubes objects for worker threads. '''
+    app = DevicesTray(
+        'org.qubes.qui.tray.Devices', qapp, dispatcher, qapp_factory)
+    return app, []
 
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     qapp = qubesadmin.Qubes()
     dispatcher = qubesadmin.events.EventsDispatcher(qapp)
-    app = DevicesTray(
-        'org.qubes.qui.tray.Devices', qapp, dispatcher)
+    app, coroutines = load_widget(qapp, dispatcher)
 
     loop = asyncio.get_event_loop()
 
-    done, _unused = loop.run_until_complete(asyncio.ensure_future(
-        dispatcher.listen_for_events()))
+    tasks = [asyncio.ensure_future(dispatcher.listen_for_events())]
+    tasks.extend(asyncio.ensure_future(c) for c in coroutines)
+
+    done, _unused = loop.run_until_complete(asyncio.wait(
+        tasks, return_when=asyncio.FIRST_EXCEPTION))
 
     exit_code = 0
     for d in done:  # pylint: disable=invalid-name
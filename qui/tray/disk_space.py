@@ -1,12 +1,28 @@
 # pylint: disable=wrong-import-position,import-error
+import array
+import asyncio
+import concurrent.futures
+import logging
 import sys
 import subprocess
+import threading
+import time
+import traceback
 import gi
 gi.require_version('Gtk', '3.0')  # isort:skip
 from gi.repository import Gtk, GObject, Gio, GLib  # isort:skip
 from qubesadmin import Qubes
 from qubesadmin.utils import size_to_human
 from qubesadmin import exc
+import qubesadmin.events
+
+import qui.icons
+import qui.prefetch
+
+import gbulb
+gbulb.install()
+
+logger = logging.getLogger(__name__)
 
 import gettext
 t = gettext.translation("desktop-linux-manager", localedir="/usr/locales",
@@ -18,75 +34,192 @@ WARN_LEVEL = 0.9
 URGENT_WARN_LEVEL = 0.95
 
 
+# bounds of the polling interval of a single pool or volume, in seconds
+MIN_POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 600
+
+# number of usage queries run at the same time, and how long (in seconds) a
+# refresh waits for each of them; a query that takes longer counts as failed
+# and is not started again before it returns
+QUERY_CONCURRENCY = 8
+QUERY_TIMEOUT = 10
+# opening the menu polls all pools and volumes if they were last all polled
+# longer than this ago, in seconds, and only those that are due otherwise
+MENU_REFRESH_AGE = 60
+
+# warn when a pool or volume is predicted to be full within this time
+FULL_WARN_TIME = 3600
+# number of usage samples kept per pool or volume to predict growth, and
+# how many are needed before a prediction is shown; two samples make a line
+# through any noise
+HISTORY_SIZE = 32
+MIN_PREDICTION_SAMPLES = 3
+
+
+def format_duration(seconds):
+    if seconds < 2 * 60:
+        return _("{} seconds").format(int(seconds))
+    if seconds < 2 * 3600:
+        return _("{} minutes").format(int(seconds / 60))
+    if seconds < 2 * 86400:
+        return _("{} hours").format(int(seconds / 3600))
+    return _("{} days").format(int(seconds / 86400))
+
+
+class UsageHistory:
+    ''' Usage samples of a pool or a volume, kept in a fixed-size ring
+    buffer backed by arrays, so memory use does not grow over time. '''
+    def __init__(self, size=HISTORY_SIZE):
+        self.size = size
+        self.times = array.array('d', [0.0]) * size
+        self.usages = array.array('d', [0.0]) * size
+        self.count = 0
+        # index where the next sample will be written
+        self.position = 0
+
+    def add(self, now, usage):
+        self.times[self.position] = now
+        self.usages[self.position] = usage
+        self.position = (self.position + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def samples(self):
+        ''' (time, usage) samples, from the oldest '''
+        start = (self.position - self.count) % self.size
+        for i in range(self.count):
+            index = (start + i) % self.size
+            yield self.times[index], self.usages[index]
+
+    def get_last(self):
+        if not self.count:
+            return None
+        return self.usages[(self.position - 1) % self.size]
+
+    def get_rate(self):
+        ''' Growth of usage per second, as a least squares fit of the
+        samples; None if there are not enough samples '''
+        if self.count < 2:
+            return None
+        samples = list(self.samples())
+        # relative times keep the sums precise
+        first_time = samples[0][0]
+        mean_time = sum(t - first_time for t, _u in samples) / self.count
+        mean_usage = sum(u for _t, u in samples) / self.count
+        covariance = sum((t - first_time - mean_time) * (u - mean_usage)
+                         for t, u in samples)
+        variance = sum((t - first_time - mean_time) ** 2 for t, _u in samples)
+        if variance == 0:
+            return None
+        return covariance / variance
+
+    def get_time_to_full(self):
+        ''' Estimated number of seconds until usage reaches 100%, or None
+        if usage does not grow or there are too few samples to tell '''
+        if self.count < MIN_PREDICTION_SAMPLES:
+            return None
+        rate = self.get_rate()
+        if not rate or rate <= 0:
+            return None
+        return max(1 - self.get_last(), 0) / rate
+
+
 class VMUsage:
+    ''' Volume usage of a running VM. The list of volumes to watch is
+    determined once, later checks only query their size and usage.
+
+    Queries only return their results, which are applied on the main loop,
+    so they can run in worker threads; they are given domain and volume
+    objects of the worker thread, `vm` is only used in the main thread. '''
     def __init__(self, vm):
         self.vm = vm
-        self.problem_volumes = {}
+        #: names of volumes to watch, None until listed
+        self.volumes = None
+        #: volume name -> usage ratio, as of the last check
+        self.usage = {}
+        #: volume name -> estimated seconds until the volume is full, only
+        #: for volumes with a prediction
+        self.time_to_full = {}
+
+    @property
+    def problem_volumes(self):
+        return {volume_name: usage
+                for volume_name, usage in self.usage.items()
+                if usage > WARN_LEVEL or
+                self.time_to_full.get(volume_name) is not None and
+                self.time_to_full[volume_name] < FULL_WARN_TIME}
 
-        self.check_usage()
-
-    def check_usage(self):
-        self.problem_volumes = {}
+    @staticmethod
+    def list_volumes(vm):
+        ''' Query which volumes of `vm` to watch; returns a dict of volume
+        name -> volume '''
         volumes_to_check = ['private']
-        if not hasattr(self.vm, 'template'):
+        if not hasattr(vm, 'template'):
             volumes_to_check.append('root')
-        for volume_name in volumes_to_check:
+        volumes = {}
+        try:
+            for volume_name in volumes_to_check:
+                if volume_name in vm.volumes:
+                    volumes[volume_name] = vm.volumes[volume_name]
+        except exc.QubesDaemonAccessError:
+            pass
+        return volumes
+
+    @staticmethod
+    def query_usage(volumes):
+        ''' Query usage of `volumes`, a dict of volume name -> volume;
+        returns a dict of volume name -> usage ratio '''
+        usage = {}
+        for volume_name, volume in volumes.items():
             try:
-                if volume_name in self.vm.volumes:
-                    size = self.vm.volumes[volume_name].size
-                    usage = self.vm.volumes[volume_name].usage
-                    if size > 0 and usage / size > WARN_LEVEL:
-                        self.problem_volumes[volume_name] = usage / size
+                size = volume.size
+                volume_usage = volume.usage
             except exc.QubesDaemonAccessError:
                 continue
+            if size > 0:
+                usage[volume_name] = volume_usage / size
+        return usage
 
 
 class VMUsageData:
-    def __init__(self, qubes_app):
-        self.qubes_app = qubes_app
+    def __init__(self, vm_usages):
         self.problematic_vms = []
 
-        self.__populate_vms()
+        self.__populate_vms(vm_usages)
 
-    def __populate_vms(self):
-        for vm in self.qubes_app.domains:
-            try:
-                if vm.is_running():
-                    usage_data = VMUsage(vm)
-                    if usage_data.problem_volumes:
-                        self.problematic_vms.append(usage_data)
-            except exc.QubesPropertyAccessError:
-                continue
+    def __populate_vms(self, vm_usages):
+        for usage_data in vm_usages:
+            if usage_data.problem_volumes:
+                self.problematic_vms.append(usage_data)
 
-    def get_vms_widgets(self):
+    def get_vms_labels(self):
+        ''' Yields (vm, label markup) of each problematic VM '''
         for vm_usage in self.problematic_vms:
-            yield self.__create_widgets(vm_usage)
+            yield vm_usage.vm, self.__get_label_text(vm_usage)
 
     @staticmethod
-    def __create_widgets(vm_usage):
-        vm = vm_usage.vm
-
-        # icon widget
+    def create_icon(vm):
         try:
             icon = getattr(vm, 'icon', vm.label.icon)
         except exc.QubesPropertyAccessError:
             icon = 'appvm-black'
-        icon_vm = Gtk.IconTheme.get_default().load_icon(icon, 16, 0)
-        icon_img = Gtk.Image.new_from_pixbuf(icon_vm)
-
-        # description widget
-        label_widget = Gtk.Label(xalign=0)
+        icon_vm = qui.icons.load_icon(icon)
+        return Gtk.Image.new_from_pixbuf(icon_vm)
 
+    @staticmethod
+    def __get_label_text(vm_usage):
         label_contents = []
 
         for volume_name, usage in vm_usage.problem_volumes.items():
-            label_contents.append('volume <b>{}</b> is {:.1%} full'.format(
-                volume_name, usage))
-
-        label_text = "<b>{}</b>: ".format(vm.name) + ", ".join(label_contents)
-        label_widget.set_markup(label_text)
+            label_content = 'volume <b>{}</b> is {:.1%} full'.format(
+                volume_name, usage)
+            time_to_full = vm_usage.time_to_full.get(volume_name)
+            if time_to_full is not None:
+                label_content += _(', full in about {}').format(
+                    format_duration(time_to_full))
+            label_contents.append(label_content)
 
-        return vm, icon_img, label_widget
+        return "<b>{}</b>: ".format(vm_usage.vm.name) + \
+            ", ".join(label_contents)
 
 
 class SettingsItem(Gtk.MenuItem):
@@ -141,11 +274,70 @@ class VMMenu(Gtk.Menu):
         self.show_all()
 
 
-class PoolUsageData:
-    def __init__(self, qubes_app):
-        self.qubes_app = qubes_app
+class PoolUsage:
+    ''' Usage of a storage pool, as of the last refresh. `query` only
+    returns the new values, which `update` applies on the main loop. '''
+    def __init__(self, pool):
+        self.name = pool.name
+        self.included_in = None
+        self.size = None
+        self.usage = 0
+        self.metadata_size = None
+        self.metadata_usage = None
+        #: estimated seconds until the pool is full
+        self.time_to_full = None
+
+    def query(self, pool):
+        ''' Query size and usage of `pool`, the pool object of the calling
+        thread; returns a dict of attributes to set with `update` '''
+        values = {}
+        try:
+            if self.included_in is None:
+                values['included_in'] = \
+                    'included_in' in getattr(pool, 'config', {})
+            values['size'] = getattr(pool, 'size', None)
+            values['usage'] = getattr(pool, 'usage', 0)
+        except (ValueError, exc.QubesDaemonAccessError):
+            values['size'] = None
+        try:
+            usage_details = pool.usage_details
+            values['metadata_size'] = usage_details.get('metadata_size', None)
+            values['metadata_usage'] = \
+                usage_details.get('metadata_usage', None)
+        except (exc.QubesPropertyAccessError, AttributeError):
+            values['metadata_size'] = None
+        return values
+
+    def update(self, values):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    @property
+    def has_details(self):
+        # pools that are included in other pools and/or have no usage data
+        # are only listed by name
+        return bool(self.size) and not self.included_in
 
-        self.pools = []
+    def get_usage(self):
+        if not self.has_details:
+            return None
+        return self.usage / self.size
+
+    def get_metadata_usage(self):
+        if not self.has_details or not self.metadata_size:
+            return None
+        return self.metadata_usage / self.metadata_size
+
+    def get_usages(self):
+        ''' Usage of data and metadata, tracked by PollScheduler as separate
+        series, as either of them may run out first '''
+        return {'data': self.get_usage(),
+                'metadata': self.get_metadata_usage()}
+
+
+class PoolUsageData:
+    def __init__(self, pool_usages):
+        self.pools = sorted(pool_usages, key=lambda pool: pool.name)
         self.total_size = 0
         self.used_size = 0
         self.warning_message = []
@@ -153,35 +345,27 @@ class PoolUsageData:
         self.__populate_pools()
 
     def __populate_pools(self):
-        try:
-            pools = sorted(self.qubes_app.pools.values())
-        except exc.QubesDaemonAccessError:
-            pools = []
-        for pool in pools:
-            self.pools.append(pool)
-            if not getattr(pool, 'size', None) or \
-                    'included_in' in getattr(pool, 'config', {}):
+        for pool in self.pools:
+            if not pool.has_details:
                 continue
-            self.total_size += getattr(pool, 'size', 0)
-            self.used_size += getattr(pool, 'usage', 0)
-            try:
-                if pool.usage/pool.size >= URGENT_WARN_LEVEL:
-                    self.warning_message.append(
-                        _("\n{:.1%} space left in pool {}").format(
-                            1-pool.usage/pool.size, pool.name))
-            except (ValueError, exc.QubesDaemonAccessError):
-                pass
-            try:
-                if pool.usage_details.get('metadata_size', None):
-                    metadata_usage = pool.usage_details['metadata_usage'] / \
-                                     pool.usage_details['metadata_size']
-                    if metadata_usage >= URGENT_WARN_LEVEL:
-                        self.warning_message.append(
-                            "\nMetadata space for pool {} is running out. "
-                            "Current usage: {.1%}".format(
-                                pool.name, metadata_usage))
-            except (exc.QubesPropertyAccessError, AttributeError):
-                pass
+            self.total_size += pool.size
+            self.used_size += pool.usage
+            if pool.get_usage() >= URGENT_WARN_LEVEL:
+                self.warning_message.append(
+                    _("\n{:.1%} space left in pool {}").format(
+                        1-pool.get_usage(), pool.name))
+            elif pool.time_to_full is not None and \
+                    pool.time_to_full < FULL_WARN_TIME:
+                self.warning_message.append(
+                    _("\nPool {} will be full in about {}").format(
+                        pool.name, format_duration(pool.time_to_full)))
+            metadata_usage = pool.get_metadata_usage()
+            if metadata_usage is not None and \
+                    metadata_usage >= URGENT_WARN_LEVEL:
+                self.warning_message.append(
+                    "\nMetadata space for pool {} is running out. "
+                    "Current usage: {:.1%}".format(
+                        pool.name, metadata_usage))
 
     def get_pools_widgets(self):
         for p in self.pools:
@@ -190,6 +374,13 @@ class PoolUsageData:
     def get_warning(self):
         return self.warning_message
 
+    def get_next_full(self):
+        ''' The pool predicted to be full first, if any '''
+        pools = [pool for pool in self.pools if pool.time_to_full is not None]
+        if not pools:
+            return None
+        return min(pools, key=lambda pool: pool.time_to_full)
+
     def get_usage(self):
         if self.total_size > 0:
             return self.used_size/self.total_size
@@ -200,15 +391,13 @@ class PoolUsageData:
         name_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         percentage_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         usage_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        prediction_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
 
         pool_name = Gtk.Label(xalign=0)
 
-        if getattr(pool, 'size', None) and \
-                'included_in' not in getattr(pool, 'config', None):
+        if pool.has_details:
             # pool with detailed usage data
-            has_metadata = 'metadata_size' in getattr(
-                pool, 'usage_details', {}) and \
-                           pool.usage_details['metadata_size']
+            metadata_usage = pool.get_metadata_usage()
 
             pool_name.set_markup('<b>{}</b>'.format(pool.name))
 
@@ -219,29 +408,22 @@ class PoolUsageData:
             name_box.pack_start(pool_name, True, True, 0)
             name_box.pack_start(data_name, True, True, 0)
 
-            if has_metadata:
+            if metadata_usage is not None:
                 metadata_name = Gtk.Label(xalign=0)
                 metadata_name.set_markup("metadata")
                 metadata_name.set_margin_left(40)
 
                 name_box.pack_start(metadata_name, True, True, 0)
 
-            try:
-                percentage = pool.usage/pool.size
-            except (exc.QubesPropertyAccessError, ValueError):
-                percentage = 0
-
             percentage_use = Gtk.Label()
-            percentage_use.set_markup(colored_percentage(percentage))
+            percentage_use.set_markup(colored_percentage(pool.get_usage()))
             percentage_use.set_justify(Gtk.Justification.RIGHT)
 
             # empty label to guarantee proper alignment
             percentage_box.pack_start(Gtk.Label(), True, True, 0)
             percentage_box.pack_start(percentage_use, True, True, 0)
 
-            if has_metadata:
-                metadata_usage = pool.usage_details['metadata_usage'] / \
-                                 pool.usage_details['metadata_size']
+            if metadata_usage is not None:
                 metadata_label = Gtk.Label()
                 metadata_label.set_markup(colored_percentage(
                     metadata_usage))
@@ -250,8 +432,8 @@ class PoolUsageData:
             numeric_label = Gtk.Label()
             numeric_label.set_markup(
                 '<span color=\'grey\'><i>{}/{}</i></span>'.format(
-                    size_to_human(getattr(pool, 'usage', 0)),
-                    size_to_human(getattr(pool, 'size', 0))))
+                    size_to_human(pool.usage),
+                    size_to_human(pool.size)))
             numeric_label.set_justify(Gtk.Justification.RIGHT)
 
             # pack with empty labels to guarantee proper alignment
@@ -259,6 +441,15 @@ class PoolUsageData:
             usage_box.pack_start(numeric_label, True, True, 0)
             usage_box.pack_start(Gtk.Label(), True, True, 0)
 
+            prediction_label = Gtk.Label()
+            if pool.time_to_full is not None:
+                prediction_label.set_markup(
+                    _('<span color=\'grey\'><i>full in about {}</i></span>')
+                    .format(format_duration(pool.time_to_full)))
+            prediction_box.pack_start(Gtk.Label(), True, True, 0)
+            prediction_box.pack_start(prediction_label, True, True, 0)
+            prediction_box.pack_start(Gtk.Label(), True, True, 0)
+
         else:
             # pool that is included in other pools and/or has no usage data
             pool_name.set_markup(
@@ -267,7 +458,89 @@ class PoolUsageData:
 
         pool_name.set_margin_left(20)
 
-        return name_box, percentage_box, usage_box
+        return name_box, percentage_box, usage_box, prediction_box
+
+
+class PollScheduler:
+    ''' Decides when usage of a pool or a volume should be polled next.
+
+    Targets far below WARN_LEVEL are polled rarely. The interval shrinks
+    as usage approaches the threshold, and when usage grows fast enough to
+    reach it before the next poll. The growth rate is fitted over a
+    `UsageHistory` of each series of a target, such as data and metadata of
+    a pool, which fill up independently. '''
+
+    def __init__(self, min_interval=MIN_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        #: key -> time of the next poll
+        self.next_poll = {}
+        #: key -> series name -> UsageHistory
+        self.histories = {}
+        #: key -> number of failed polls in a row
+        self.failures = {}
+
+    def is_due(self, key, now):
+        return now >= self.next_poll.get(key, 0)
+
+    def update(self, key, usages, now):
+        ''' Record usage polled at time `now`, given as a dict of series
+        name -> usage (None if unknown), and schedule the next poll by the
+        series needing it first '''
+        interval = self.max_interval
+        for series, usage in usages.items():
+            if usage is None:
+                continue
+            history = self.histories.setdefault(key, {}).setdefault(
+                series, UsageHistory())
+            history.add(now, usage)
+            interval = min(interval,
+                           self.get_interval(usage, history.get_rate()))
+        self.next_poll[key] = now + interval
+        self.failures.pop(key, None)
+
+    def failed(self, key, now):
+        ''' Schedule the next poll after a failed one, doubling the interval
+        with each failure in a row up to max_interval '''
+        failures = self.failures.get(key, 0) + 1
+        self.failures[key] = failures
+        self.next_poll[key] = now + min(self.min_interval * 2 ** failures,
+                                        self.max_interval)
+
+    def get_time_to_full(self, key):
+        ''' The earliest predicted time to full of the series of `key` '''
+        times = [history.get_time_to_full()
+                 for history in self.histories.get(key, {}).values()]
+        times = [time_to_full for time_to_full in times
+                 if time_to_full is not None]
+        return min(times) if times else None
+
+    def forget(self, key):
+        self.next_poll.pop(key, None)
+        self.histories.pop(key, None)
+        self.failures.pop(key, None)
+
+    def get_interval(self, usage, rate=None):
+        ''' Interval until the next poll of a series at `usage`, growing by
+        `rate` per second (None if not known yet) '''
+        if usage is None:
+            # no usage data available
+            return self.max_interval
+        if usage >= WARN_LEVEL:
+            if rate is None or rate > 0:
+                return self.min_interval
+            # above the threshold, but not growing; what is left is the
+            # headroom until the target is full
+            headroom = min(max(1 - usage, 0) / (1 - WARN_LEVEL), 1)
+        else:
+            headroom = (WARN_LEVEL - usage) / WARN_LEVEL
+        interval = self.min_interval + \
+            (self.max_interval - self.min_interval) * headroom ** 2
+        if rate is not None and rate > 0:
+            # poll a few times before the threshold is reached
+            interval = min(interval, (WARN_LEVEL - usage) / rate / 4)
+        return max(interval, self.min_interval)
 
 
 def colored_percentage(value):
@@ -296,14 +569,234 @@ def emit_notification(gtk_app, title, text, vm=None):
     gtk_app.send_notification(None, notification)
 
 
+class UsageQueries:
+    ''' Runs usage queries of pools and VMs in a thread pool, and holds
+    the state of the refresh waiting for them.
+
+    At most `concurrency` queries run at a time. qubesadmin objects are not
+    thread-safe, so each thread makes its own Qubes object with
+    `qapp_factory` and looks pools and VMs up in it. '''
+
+    def __init__(self, qapp_factory=Qubes, concurrency=QUERY_CONCURRENCY):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency)
+        self.slots = asyncio.Semaphore(concurrency)
+        #: scheduler keys of queries that have not returned yet
+        self.pending = set()
+        self.qapp_factory = qapp_factory
+        self.local = threading.local()
+        #: task of a refresh waiting for its queries, whether it polls all
+        #: pools and volumes, and whether to poll all of them after it
+        self.refresh_future = None
+        self.refresh_forced = False
+        self.refresh_again = False
+
+    async def run(self, key, target, volume_names):
+        ''' Run `query` in the thread pool; returns its result, None if
+        it failed or took longer than QUERY_TIMEOUT, and the time it
+        started. `key` stays in `pending` until the query returns. '''
+        loop = asyncio.get_event_loop()
+        # a hung query keeps its slot, as it keeps its worker thread
+        await self.slots.acquire()
+        now = time.monotonic()
+        future = loop.run_in_executor(
+            self.pool, self.query, target, volume_names)
+        future.add_done_callback(lambda _future: self.returned(key))
+        try:
+            result = await asyncio.wait_for(
+                asyncio.shield(future), QUERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            result = None
+        except Exception:  # pylint: disable=broad-except
+            # one failing query must not end the whole refresh
+            logger.exception('Failed to query disk usage of %s', key)
+            result = None
+        return result, now
+
+    def returned(self, key):
+        self.pending.discard(key)
+        self.slots.release()
+
+    def query(self, target, volume_names):
+        ''' Run in the thread pool; returns the result for
+        `DiskSpace.apply_result`, or None if the query failed. Only reads
+        `target`, and looks its pool or VM up in the Qubes object of the
+        thread. '''
+        qapp = getattr(self.local, 'qapp', None)
+        if qapp is None:
+            qapp = self.local.qapp = self.qapp_factory()
+        try:
+            if isinstance(target, PoolUsage):
+                return target.query(self.get_local_pool(qapp, target.name))
+            vm = qapp.domains.get_blind(target.vm.name)
+            if target.volumes is None:
+                volumes = target.list_volumes(vm)
+            else:
+                volumes = {name: vm.volumes[name]
+                           for name in volume_names or target.volumes}
+            return list(volumes), target.query_usage(volumes)
+        except (KeyError, exc.QubesException):
+            # the pool or VM may have been removed in the meantime
+            return None
+
+    def get_local_pool(self, qapp, name):
+        ''' Pool object of the calling thread; pools are listed again only
+        when one is missing '''
+        pools = getattr(self.local, 'pools', {})
+        if name not in pools:
+            pools = self.local.pools = {
+                pool.name: pool for pool in qapp.pools.values()}
+        return pools[name]
+
+
+class UsageMenu(Gtk.Menu):
+    ''' Menu of the widget. Its items are made once and `update` changes
+    them in place, so a refresh does not close an open submenu. '''
+
+    def __init__(self):
+        super().__init__()
+        self.set_reserve_toggle_size(False)
+
+        self.percentage_label = Gtk.Label()
+        self.progress_bar = Gtk.LevelBar()
+        self.append(self.make_top_box())
+
+        self.append(self.make_title_item('Volumes'))
+        self.pools_item = Gtk.MenuItem()
+        self.pools_item.set_sensitive(False)
+        self.append(self.pools_item)
+
+        self.warnings_title = self.make_title_item('Qubes warnings')
+        self.append(self.warnings_title)
+        #: VM name -> (menu item, label) of each problematic VM
+        self.vm_items = {}
+
+        self.age_label = Gtk.Label(xalign=0)
+        age_item = Gtk.MenuItem()
+        age_item.add(self.age_label)
+        age_item.set_sensitive(False)
+        self.append(age_item)
+
+        self.show_all()
+
+    def update(self, pool_data, vm_data, age_text):
+        self.percentage_label.set_markup(
+            colored_percentage(pool_data.get_usage()))
+        self.progress_bar.set_value(pool_data.get_usage()*100)
+
+        grid = Gtk.Grid()
+        col_no = 0
+        for (label1, label2, label3, label4) in \
+                pool_data.get_pools_widgets():
+            grid.attach(label1, 0, col_no, 1, 1)
+            grid.attach(label2, 1, col_no, 1, 1)
+            grid.attach(label3, 2, col_no, 1, 1)
+            grid.attach(label4, 3, col_no, 1, 1)
+            col_no += 1
+        grid.set_column_spacing(20)
+        old_grid = self.pools_item.get_child()
+        if old_grid is not None:
+            self.pools_item.remove(old_grid)
+        self.pools_item.add(grid)
+        grid.show_all()
+
+        self.warnings_title.set_visible(bool(vm_data.problematic_vms))
+        vm_labels = {vm.name: (vm, text)
+                     for vm, text in vm_data.get_vms_labels()}
+        for vm_name in list(self.vm_items):
+            if vm_name not in vm_labels:
+                self.remove(self.vm_items.pop(vm_name)[0])
+        for vm_name, (vm, text) in vm_labels.items():
+            if vm_name not in self.vm_items:
+                self.vm_items[vm_name] = self.make_vm_item(vm)
+            self.vm_items[vm_name][1].set_markup(text)
+
+        self.age_label.set_markup(
+            '<span color=\'grey\'><i>{}</i></span>'.format(age_text))
+
+    def make_vm_item(self, vm):
+        ''' Insert an item of a problematic VM before the age item;
+        returns the item and its label '''
+        label = Gtk.Label(xalign=0)
+        hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
+        hbox.pack_start(VMUsageData.create_icon(vm), False, False, 0)
+        hbox.pack_start(label, False, False, 5)
+
+        vm_menu_item = Gtk.MenuItem()
+        vm_menu_item.add(hbox)
+        vm_menu_item.set_submenu(VMMenu(vm))
+        vm_menu_item.show_all()
+
+        self.insert(vm_menu_item, len(self.get_children()) - 1)
+        return vm_menu_item, label
+
+    @staticmethod
+    def make_title_item(text):
+        label = Gtk.Label(xalign=0)
+        label.set_markup(_("<b>{}</b>".format(text)))
+        menu_item = Gtk.MenuItem()
+        menu_item.add(label)
+        menu_item.set_sensitive(False)
+        return menu_item
+
+    def make_top_box(self):
+        grid = Gtk.Grid()
+
+        name_label = Gtk.Label(xalign=0)
+        name_label.set_markup(_("<b>Total disk usage</b>"))
+
+        percentage_value = self.percentage_label
+        percentage_value.set_margin_top(10)
+
+        progress_bar = self.progress_bar
+        progress_bar.set_min_value(0)
+        progress_bar.set_max_value(100)
+        progress_bar.set_vexpand(True)
+        progress_bar.set_hexpand(True)
+        progress_bar.set_margin_left(20)
+        progress_bar.set_margin_right(10)
+        progress_bar.set_margin_top(10)
+
+        grid.attach(name_label, 0, 0, 1, 1)
+        grid.attach(progress_bar, 0, 1, 1, 1)
+        grid.attach(percentage_value, 1, 1, 1, 1)
+
+        progress_bar_item = Gtk.MenuItem()
+        progress_bar_item.add(grid)
+
+        progress_bar_item.set_sensitive(False)
+
+        return progress_bar_item
+
+
 class DiskSpace(Gtk.Application):
-    def __init__(self, **properties):
+    def __init__(self, qapp, dispatcher, qapp_factory=Qubes, **properties):
         super().__init__(**properties)
 
         self.pool_warned = False
         self.vms_warned = set()
 
-        self.qubes_app = Qubes()
+        self.qubes_app = qapp
+        self.dispatcher = dispatcher
+
+        self.scheduler = PollScheduler()
+        self.queries = UsageQueries(qapp_factory)
+        # monotonic time of the last refresh of all pools and volumes
+        self.snapshot_time = None
+        self.menu = None
+
+        # usage data of pools and running VMs, kept current from events
+        self.pool_usages = {}
+        self.vm_usages = {}
+        self.initialize_pool_data()
+        self.initialize_vm_data()
+
+        self.dispatcher.add_handler('domain-start', self.vm_start)
+        self.dispatcher.add_handler('domain-shutdown', self.vm_shutdown)
+        self.dispatcher.add_handler('domain-start-failed', self.vm_shutdown)
+        self.dispatcher.add_handler('domain-delete', self.vm_removed)
+        self.dispatcher.add_handler('pool-add', self.pool_added)
+        self.dispatcher.add_handler('pool-delete', self.pool_removed)
 
         self.set_application_id("org.qubes.qui.tray.DiskSpace")
         self.register()
@@ -314,21 +807,185 @@ class DiskSpace(Gtk.Application):
 
         self.icon = Gtk.StatusIcon()
         self.icon.connect('button-press-event', self.make_menu)
-        self.refresh_icon()
+        self.set_icon_state()
+        self.refresh_in_background()
+
+        # the scheduler decides which pools and volumes are actually polled
+        GObject.timeout_add_seconds(MIN_POLL_INTERVAL, self.refresh_icon)
 
-        GObject.timeout_add_seconds(120, self.refresh_icon)
+    def initialize_pool_data(self):
+        try:
+            pools = self.qubes_app.pools.values()
+        except exc.QubesDaemonAccessError:
+            pools = []
+        for pool in pools:
+            self.pool_usages[pool.name] = PoolUsage(pool)
+
+    def initialize_vm_data(self):
+        # template is read only for running domains, one by one
+        preloaded = qui.prefetch.preload_domains(
+            self.qubes_app, properties=())
+        for vm in self.qubes_app.domains:
+            try:
+                if preloaded.is_running(vm):
+                    self.vm_usages[vm.name] = VMUsage(vm)
+            except exc.QubesPropertyAccessError:
+                continue
 
-        Gtk.main()
+    def vm_start(self, vm, _event, **_kwargs):
+        self.vm_usages[vm.name] = VMUsage(vm)
+
+    def vm_shutdown(self, vm, _event, **_kwargs):
+        self.forget_vm(vm.name)
+
+    def vm_removed(self, _submitter, _event, vm, **_kwargs):
+        self.forget_vm(str(vm))
+
+    def forget_vm(self, vm_name):
+        vm_usage = self.vm_usages.pop(vm_name, None)
+        if vm_usage is not None:
+            self.scheduler.forget((vm_name, None))
+            for volume_name in vm_usage.volumes or ():
+                self.scheduler.forget((vm_name, volume_name))
+
+    def pool_added(self, _submitter, _event, pool, **_kwargs):
+        try:
+            self.pool_usages[pool] = PoolUsage(self.qubes_app.pools[pool])
+        except (KeyError, exc.QubesException):
+            # the pool was removed again or we have no access to it
+            pass
+
+    def pool_removed(self, _submitter, _event, pool, **_kwargs):
+        self.pool_usages.pop(pool, None)
+        self.scheduler.forget(pool)
+
+    def get_due_tasks(self, force, now):
+        ''' Returns a dict of scheduler key -> (PoolUsage or VMUsage, volume
+        names or None for all) of targets due according to the scheduler,
+        or of all of them if `force` is set '''
+        tasks = {}
+        for pool_name, pool_usage in self.pool_usages.items():
+            if force or self.scheduler.is_due(pool_name, now):
+                tasks[pool_name] = (pool_usage, None)
+        for vm_name, vm_usage in self.vm_usages.items():
+            if vm_usage.volumes is None:
+                # listing volumes is a call too, make it part of the query
+                if force or self.scheduler.is_due((vm_name, None), now):
+                    tasks[(vm_name, None)] = (vm_usage, None)
+                continue
+            for volume_name in vm_usage.volumes:
+                key = (vm_name, volume_name)
+                if force or self.scheduler.is_due(key, now):
+                    tasks[key] = (vm_usage, [volume_name])
+        return tasks
+
+    async def refresh(self, force=False):
+        ''' Refresh usage of pools and volumes that are due according to
+        the scheduler, or of all of them if `force` is set. Returns True
+        if anything was polled.
+
+        Queries run concurrently in worker threads of `queries` and only
+        return their results, which are applied here, on the main loop, so
+        the menu and warnings never see usage change under them. '''
+        now = time.monotonic()
+        queries = []
+        for key, task in self.get_due_tasks(force, now).items():
+            # a query still running from an earlier refresh is not repeated
+            if key not in self.queries.pending:
+                self.queries.pending.add(key)
+                queries.append(self.run_query(key, *task))
+        results = await asyncio.gather(*queries)
+
+        if force:
+            self.snapshot_time = now
+        return any(results)
+
+    async def run_query(self, key, target, volume_names):
+        ''' Run a query and apply its result; returns True if it was
+        applied.
+
+        A query that fails, with any exception, or takes longer than
+        QUERY_TIMEOUT, is retried with a growing interval; a late result is
+        dropped, as are results for pools and VMs that are gone by then. '''
+        result, now = await self.queries.run(key, target, volume_names)
+
+        if not self.is_current(target):
+            # the pool was removed or the VM shut down in the meantime
+            return False
+        if result is None:
+            self.scheduler.failed(key, now)
+            return False
+        self.apply_result(target, volume_names, result, now)
+        return True
+
+    def is_current(self, target):
+        if isinstance(target, PoolUsage):
+            return self.pool_usages.get(target.name) is target
+        return self.vm_usages.get(target.vm.name) is target
+
+    def apply_result(self, target, volume_names, result, now):
+        ''' Apply the result of a query polled at time `now` to its target
+        and the scheduler '''
+        if isinstance(target, PoolUsage):
+            target.update(result)
+            self.scheduler.update(target.name, target.get_usages(), now)
+            target.time_to_full = self.scheduler.get_time_to_full(target.name)
+            return
+        vm_name = target.vm.name
+        volumes, usage = result
+        if target.volumes is None:
+            target.volumes = volumes
+        target.usage.update(usage)
+        for volume_name in volume_names or volumes:
+            self.scheduler.update(
+                (vm_name, volume_name),
+                {'usage': target.usage.get(volume_name)}, now)
+            time_to_full = self.scheduler.get_time_to_full(
+                (vm_name, volume_name))
+            if time_to_full is None:
+                # no prediction (yet), or usage stopped growing
+                target.time_to_full.pop(volume_name, None)
+            else:
+                target.time_to_full[volume_name] = time_to_full
 
     def refresh_icon(self):
-        pool_data = PoolUsageData(self.qubes_app)
-        vm_data = VMUsageData(self.qubes_app)
+        self.refresh_in_background(force=False)
+        return True  # needed for Gtk to correctly loop the function
+
+    def refresh_in_background(self, force=True):
+        ''' Poll without blocking the main loop, then update the icon and
+        the menu, if it is still open. Polls all pools and volumes if `force`
+        is set, otherwise only those that are due. '''
+        queries = self.queries
+        if queries.refresh_future is not None:
+            # repeat a partial refresh when it is done
+            if force and not queries.refresh_forced:
+                queries.refresh_again = True
+            return
+        queries.refresh_forced = force
+        queries.refresh_future = asyncio.ensure_future(self.refresh(force))
+        queries.refresh_future.add_done_callback(self.refresh_done)
+
+    def refresh_done(self, future):
+        self.queries.refresh_future = None
+        if future.result():
+            self.update_warnings()
+        if self.queries.refresh_again:
+            self.queries.refresh_again = False
+            self.refresh_in_background()
+        if self.menu is not None and self.menu.get_mapped():
+            self.populate_menu(self.menu)
+
+    def update_warnings(self):
+        pool_data = PoolUsageData(self.pool_usages.values())
+        vm_data = VMUsageData(self.vm_usages.values())
         pool_warning = pool_data.get_warning()
         vm_warning = vm_data.problematic_vms
 
         # set icon
         self.set_icon_state(pool_warning=pool_warning,
-                            vm_warning=vm_warning)
+                            vm_warning=vm_warning,
+                            next_full=pool_data.get_next_full())
 
         # emit notification
         if pool_warning:
@@ -344,25 +1001,25 @@ class DiskSpace(Gtk.Application):
 
         if vm_warning:
             currently_problematic_vms = [x.vm for x in vm_warning]
-            for vm in self.vms_warned:
-                if vm not in currently_problematic_vms:
-                    self.vms_warned.remove(vm)
+            self.vms_warned.intersection_update(currently_problematic_vms)
             for vm in currently_problematic_vms:
-                if not vm.features.get('disk-space-not-notify', False) and vm\
-                        not in self.vms_warned:
+                # the feature is a call to qubesd; it is read once while
+                # the VM stays problematic
+                if vm in self.vms_warned:
+                    continue
+                self.vms_warned.add(vm)
+                if not vm.features.get('disk-space-not-notify', False):
                     emit_notification(
                         self,
                         _("Qube usage warning"),
                         _("Qube {} is running out of storage space.".format(
                             vm.name)),
                         vm=vm)
-                    self.vms_warned.add(vm)
         else:
             self.vms_warned = set()
 
-        return True  # needed for Gtk to correctly loop the function
-
-    def set_icon_state(self, pool_warning=None, vm_warning=None):
+    def set_icon_state(self, pool_warning=None, vm_warning=None,
+                       next_full=None):
         if pool_warning or vm_warning:
             self.icon.set_from_icon_name("dialog-warning")
             text = _("<b>Qubes Disk Space Monitor</b>\n\nWARNING!")
@@ -375,98 +1032,84 @@ class DiskSpace(Gtk.Application):
             self.icon.set_tooltip_markup(text)
         else:
             self.icon.set_from_icon_name("drive-harddisk")
-            self.icon.set_tooltip_markup(
-                _('<b>Qubes Disk Space Monitor</b>\nView free disk space.'))
+            text = _('<b>Qubes Disk Space Monitor</b>\nView free disk space.')
+            if next_full:
+                text += _('\nPool {} will be full in about {}').format(
+                    next_full.name, format_duration(next_full.time_to_full))
+            self.icon.set_tooltip_markup(text)
 
     def make_menu(self, _unused, _event):
-        pool_data = PoolUsageData(self.qubes_app)
-        vm_data = VMUsageData(self.qubes_app)
-
-        menu = Gtk.Menu()
-
-        menu.append(self.make_top_box(pool_data))
-
-        menu.append(self.make_title_item('Volumes'))
-
-        grid = Gtk.Grid()
-        col_no = 0
-        for (label1, label2, label3) in pool_data.get_pools_widgets():
-            grid.attach(label1, 0, col_no, 1, 1)
-            grid.attach(label2, 1, col_no, 1, 1)
-            grid.attach(label3, 2, col_no, 1, 1)
-            col_no += 1
-
-        grid.set_column_spacing(20)
-        grid_menu_item = Gtk.MenuItem()
-        grid_menu_item.add(grid)
-        grid_menu_item.set_sensitive(False)
-        menu.append(grid_menu_item)
-
-        if vm_data.problematic_vms:
-            menu.append(self.make_title_item('Qubes warnings'))
-
-            for (vm, label1, label2) in vm_data.get_vms_widgets():
-                hbox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
-                hbox.pack_start(label1, False, False, 0)
-                hbox.pack_start(label2, False, False, 5)
-
-                vm_menu_item = Gtk.MenuItem()
-                vm_menu_item.add(hbox)
-
-                vm_menu_item.set_submenu(VMMenu(vm))
-
-                menu.append(vm_menu_item)
-
-        menu.set_reserve_toggle_size(False)
-
-        menu.show_all()
-        menu.popup_at_pointer(None)  # use current event
-
-    @staticmethod
-    def make_title_item(text):
-        label = Gtk.Label(xalign=0)
-        label.set_markup(_("<b>{}</b>".format(text)))
-        menu_item = Gtk.MenuItem()
-        menu_item.add(label)
-        menu_item.set_sensitive(False)
-        return menu_item
-
-    @staticmethod
-    def make_top_box(pool_data):
-        grid = Gtk.Grid()
-
-        name_label = Gtk.Label(xalign=0)
-        name_label.set_markup(_("<b>Total disk usage</b>"))
+        # show the last snapshot right away, the refresh updates it in place;
+        # all pools and volumes are polled only if the snapshot is old
+        outdated = self.snapshot_time is None or \
+            time.monotonic() - self.snapshot_time > MENU_REFRESH_AGE
+        self.refresh_in_background(force=outdated)
+
+        self.menu = UsageMenu()
+        self.populate_menu(self.menu)
+        self.menu.popup_at_pointer(None)  # use current event
+
+    def populate_menu(self, menu):
+        menu.update(PoolUsageData(self.pool_usages.values()),
+                    VMUsageData(self.vm_usages.values()),
+                    self.get_age_text())
+
+    def get_age_text(self):
+        if self.snapshot_time is None:
+            text = _("Not refreshed yet")
+        else:
+            age = time.monotonic() - self.snapshot_time
+            if age < 1:
+                text = _("Updated just now")
+            else:
+                text = _("Updated {} ago").format(format_duration(age))
+        if self.queries.refresh_future is not None:
+            text += _(", refreshing...")
+        return text
 
-        percentage_value = Gtk.Label()
-        percentage_value.set_markup(colored_percentage(pool_data.get_usage()))
-        percentage_value.set_margin_top(10)
 
-        progress_bar = Gtk.LevelBar()
-        progress_bar.set_min_value(0)
-        progress_bar.set_max_value(100)
-        progress_bar.set_value(pool_data.get_usage()*100)
-        progress_bar.set_vexpand(True)
-        progress_bar.set_hexpand(True)
-        progress_bar.set_margin_left(20)
-        progress_bar.set_margin_right(10)
-        progress_bar.set_margin_top(10)
+def load_widget(qapp, dispatcher, qapp_factory=Qubes):
+    ''' Create the widget for `qui.tray.host`; returns the application and
+    coroutines that have to run along with the events dispatcher.
+    `qapp_factory` makes Qubes objects for worker threads. '''
+    return DiskSpace(qapp, dispatcher, qapp_factory), []
 
-        grid.attach(name_label, 0, 0, 1, 1)
-        grid.attach(progress_bar, 0, 1, 1, 1)
-        grid.attach(percentage_value, 1, 1, 1, 1)
 
-        progress_bar_item = Gtk.MenuItem()
-        progress_bar_item.add(grid)
+def main():
+    logging.basicConfig(level=logging.INFO)
+    qapp = Qubes()
+    dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+    app, coroutines = load_widget(qapp, dispatcher)
 
-        progress_bar_item.set_sensitive(False)
+    loop = asyncio.get_event_loop()
 
-        return progress_bar_item
+    tasks = [asyncio.ensure_future(dispatcher.listen_for_events())]
+    tasks.extend(asyncio.ensure_future(c) for c in coroutines)
 
+    done, _unused = loop.run_until_complete(asyncio.wait(
+        tasks, return_when=asyncio.FIRST_EXCEPTION))
 
-def main():
-    app = DiskSpace()
-    app.run()
+    exit_code = 0
+    for d in done:  # pylint: disable=invalid-name
+        try:
+            d.result()
+        except Exception:  # pylint: disable=broad-except
+            exc_type, exc_value = sys.exc_info()[:2]
+            dialog = Gtk.MessageDialog(
+                None, 0, Gtk.MessageType.ERROR, Gtk.ButtonsType.OK)
+            dialog.set_title(_("Houston, we have a problem..."))
+            dialog.set_markup(_(
+                "<b>Whoops. A critical error in Disk Space Widget has "
+                "occured.</b> This is most likely a bug in the widget. To "
+                "restart the widget, run 'qui-disk-space' in dom0."))
+            dialog.format_secondary_markup(
+                "\n<b>{}</b>: {}\n{}".format(
+                   exc_type.__name__, exc_value, traceback.format_exc(limit=10)
+                ))
+            dialog.run()
+            exit_code = 1
+    del app
+    return exit_code
 
 
 if __name__ == '__main__':
@@ -3,9 +3,13 @@
 # pylint: disable=wrong-import-position,import-error
 ''' A menu listing domains '''
 import asyncio
+import bisect
+import concurrent.futures
+import logging
 import subprocess
 import sys
 import os
+import threading
 import traceback
 
 import qubesadmin
@@ -14,6 +18,8 @@ import qubesadmin.events
 from qubesadmin import exc
 
 import qui.decorators
+import qui.icons
+import qui.prefetch
 import gi  # isort:skip
 gi.require_version('Gtk', '3.0')  # isort:skip
 from gi.repository import Gio, Gtk, GObject  # isort:skip
@@ -37,6 +43,35 @@ STATE_DICTIONARY = {
     'domain-shutdown-failed': 'Running'
 }
 
+# how often (in milliseconds) buffered vm-stats are applied to the menu
+STATS_INTERVAL = 1000
+
+# how many domain actions may be processed by qubesd at the same time
+ACTION_CONCURRENCY = 8
+
+# action: (states of domains the action applies to, progress message,
+#          success message, failure message); each is available as the
+#          app.do-<action>-all action, used by notification buttons
+BULK_ACTIONS = {
+    'pause': (('Running',),
+              _('Pausing {} qubes...'),
+              _('{} qubes have been paused.'),
+              _('Failed to pause {} of {} qubes:')),
+    'unpause': (('Paused',),
+                _('Unpausing {} qubes...'),
+                _('{} qubes have been unpaused.'),
+                _('Failed to unpause {} of {} qubes:')),
+    'shutdown': (('Running',),
+                 _('Shutting down {} qubes...'),
+                 _('{} qubes have been shut down.'),
+                 _('Failed to shut down {} of {} qubes:')),
+}
+
+# bulk actions that are hard to undo ask for confirmation first
+CONFIRMED_BULK_ACTIONS = {
+    'shutdown': _('Shut down all {} running qubes?'),
+}
+
 
 class IconCache:
     def __init__(self):
@@ -49,16 +84,184 @@ class IconCache:
             'unpause': 'media-playback-start',
             'files': 'system-file-manager'
         }
-        self.icons = {}
 
     def get_icon(self, icon_name):
-        if icon_name in self.icons.keys():
-            icon = self.icons[icon_name]
-        else:
-            icon = Gtk.IconTheme.get_default().load_icon(
-                self.icon_files[icon_name], 16, 0)
-            self.icons[icon_name] = icon
-        return icon
+        return qui.icons.load_icon(self.icon_files[icon_name])
+
+
+class DomainStateStore:
+    ''' Local copy of domain power states, properties and features.
+
+    The store is seeded once at startup and afterwards kept current from
+    dispatcher events only, so that tray logic can read from memory; qubesd
+    is queried only on a cache miss. Property changes invalidate the cached
+    value, features are updated with the value carried by the event.
+    Callables in `state_listeners` are called with (vm, old_state, new_state)
+    after the store has processed a power state change.
+
+    The store also counts running and paused domains (AdminVMs excluded),
+    so that checking whether all running domains are paused takes constant
+    time. '''
+
+    def __init__(self, qapp, dispatcher):
+        self.qapp = qapp
+        self.dispatcher = dispatcher
+
+        self.states = {}
+        self.properties = {}
+        self.features = {}
+
+        self.running_count = 0
+        self.paused_count = 0
+
+        self.state_listeners = []
+
+    def seed(self):
+        # the menu shows domains that are not halted; dom0 reads fewer
+        # properties than the preload would fetch. The dispatcher keeps the
+        # property cache current.
+        preloaded = qui.prefetch.preload_domains(
+            self.qapp, enable_cache=True,
+            domain_filter=lambda vm, state: state not in (None, 'Halted')
+            and vm.klass != 'AdminVM')
+
+        self.states.clear()
+        self.running_count = 0
+        self.paused_count = 0
+        for vm in self.qapp.domains:
+            self.properties.setdefault(vm.name, {})['klass'] = vm.klass
+            if vm.name in preloaded.states:
+                self._set_state(vm, preloaded.states[vm.name])
+            else:
+                self._fetch_state(vm)
+
+    def register_events(self):
+        for event in STATE_DICTIONARY:
+            self.dispatcher.add_handler(event, self.on_state_change)
+        self.dispatcher.add_handler('domain-add', self.on_domain_add)
+        self.dispatcher.add_handler('domain-delete', self.on_domain_delete)
+        self.dispatcher.add_handler('property-set:*', self.on_property_change)
+        self.dispatcher.add_handler('property-reset:*',
+                                    self.on_property_change)
+        self.dispatcher.add_handler('domain-feature-set:*',
+                                    self.on_feature_set)
+        self.dispatcher.add_handler('domain-feature-delete:*',
+                                    self.on_feature_delete)
+
+    def unregister_events(self):
+        for event in STATE_DICTIONARY:
+            self.dispatcher.remove_handler(event, self.on_state_change)
+        self.dispatcher.remove_handler('domain-add', self.on_domain_add)
+        self.dispatcher.remove_handler('domain-delete', self.on_domain_delete)
+        self.dispatcher.remove_handler('property-set:*',
+                                       self.on_property_change)
+        self.dispatcher.remove_handler('property-reset:*',
+                                       self.on_property_change)
+        self.dispatcher.remove_handler('domain-feature-set:*',
+                                       self.on_feature_set)
+        self.dispatcher.remove_handler('domain-feature-delete:*',
+                                       self.on_feature_delete)
+
+    def _fetch_state(self, vm, fallback='Halted'):
+        try:
+            state = vm.get_power_state()
+        except exc.QubesException:
+            # VM might have been already destroyed
+            if vm not in self.qapp.domains:
+                return None
+            # or we might not have permission to access its power state;
+            # later events will update the state
+            state = fallback
+        except Exception:  # pylint: disable=broad-except
+            # it's a fragile DispVM
+            return fallback
+        self._set_state(vm, state)
+        return state
+
+    def _set_state(self, vm, state):
+        old_state = self.states.get(str(vm))
+        self.states[str(vm)] = state
+        if self.get_property(vm, 'klass') != 'AdminVM':
+            self._count(old_state, -1)
+            self._count(state, 1)
+        return old_state
+
+    def _count(self, state, delta):
+        if state in (None, 'Halted'):
+            return
+        self.running_count += delta
+        if state == 'Paused':
+            self.paused_count += delta
+
+    def _forget(self, name):
+        old_state = self.states.pop(name, None)
+        if self.properties.get(name, {}).get('klass') != 'AdminVM':
+            self._count(old_state, -1)
+        self.properties.pop(name, None)
+        self.features.pop(name, None)
+
+    def get_state(self, vm, fallback='Halted'):
+        ''' Returns the power state of `vm`, `fallback` if it cannot be
+        fetched, or None if the VM no longer exists '''
+        state = self.states.get(str(vm))
+        if state is None:
+            state = self._fetch_state(vm, fallback)
+        return state
+
+    def is_running(self, vm):
+        return self.get_state(vm) not in (None, 'Halted')
+
+    def is_paused(self, vm):
+        return self.get_state(vm) == 'Paused'
+
+    def have_running_and_all_are_paused(self):
+        return 0 < self.paused_count == self.running_count
+
+    def get_property(self, vm, prop, default=None):
+        properties = self.properties.setdefault(str(vm), {})
+        if prop not in properties:
+            try:
+                properties[prop] = getattr(vm, prop)
+            except (AttributeError, exc.QubesException):
+                # no such property or no permission to access it
+                properties[prop] = default
+        return properties[prop]
+
+    def get_feature(self, vm, feature, default=None):
+        features = self.features.setdefault(str(vm), {})
+        if feature not in features:
+            try:
+                features[feature] = vm.features.get(feature, None)
+            except exc.QubesException:
+                # no access to VM features, or the VM is gone
+                return default
+        value = features[feature]
+        return default if value is None else value
+
+    def on_state_change(self, vm, event, **_kwargs):
+        new_state = STATE_DICTIONARY[event]
+        old_state = self._set_state(vm, new_state)
+        for listener in self.state_listeners:
+            listener(vm, old_state, new_state)
+
+    def on_domain_add(self, _submitter, _event, vm, **_kwargs):
+        # state will be fetched on first access or set by the next event
+        self._forget(str(vm))
+
+    def on_domain_delete(self, _submitter, _event, vm, **_kwargs):
+        self._forget(str(vm))
+
+    def on_property_change(self, vm, event, **_kwargs):
+        if not vm:  # global properties changed
+            return
+        prop = event.split(':', 1)[1]
+        self.properties.get(str(vm), {}).pop(prop, None)
+
+    def on_feature_set(self, vm, _event, feature, value, **_kwargs):
+        self.features.setdefault(str(vm), {})[feature] = value
+
+    def on_feature_delete(self, vm, _event, feature, **_kwargs):
+        self.features.setdefault(str(vm), {})[feature] = None
 
 
 def show_error(title, text):
@@ -70,12 +273,82 @@ def show_error(title, text):
     dialog.show()
 
 
+class ActionExecutor:
+    ''' Runs blocking qubesadmin calls for domain actions in a thread pool
+    of the (gbulb) event loop, so that the tray keeps handling events while
+    qubesd processes the request. At most `concurrency` calls run at the same
+    time. An action that is already in flight for a domain is not started
+    again; the pending future is returned instead.
+
+    qubesadmin objects are not thread-safe, so every worker thread makes its
+    own `qubesadmin.Qubes` object with `qapp_factory` and looks domains up
+    in it by name; the caller's objects are used only in the main thread. '''
+
+    def __init__(self, loop=None, concurrency=ACTION_CONCURRENCY,
+                 qapp_factory=qubesadmin.Qubes):
+        self.loop = loop if loop else asyncio.get_event_loop()
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency)
+        self.qapp_factory = qapp_factory
+        self.local = threading.local()
+        #: (vm name, action, args) -> future
+        self.in_flight = {}
+
+    def _call(self, vm_name, action, args):
+        # runs in a worker thread
+        qapp = getattr(self.local, 'qapp', None)
+        if qapp is None:
+            qapp = self.local.qapp = self.qapp_factory()
+        vm = qapp.domains.get_blind(vm_name)
+        return getattr(vm, action)(*args)
+
+    def submit(self, vm, action, *args):
+        ''' Start calling method `action` of `vm` with `args` and return
+        a future of the result. '''
+        key = (vm.name, action, args)
+        if key not in self.in_flight:
+            future = self.loop.run_in_executor(
+                self.pool, self._call, vm.name, action, args)
+            self.in_flight[key] = future
+            future.add_done_callback(
+                lambda _future: self.in_flight.pop(key, None))
+        return self.in_flight[key]
+
+    def run(self, vm, action, error_title, error_message, *args):
+        ''' Like `submit`, but on failure an error dialog is shown, with
+        `error_message` formatted with the domain name and the error. '''
+        if (vm.name, action, args) in self.in_flight:
+            return self.in_flight[(vm.name, action, args)]
+
+        def report_error(future):
+            if future.cancelled():
+                return
+            ex = future.exception()
+            if isinstance(ex, exc.QubesException):
+                show_error(error_title, error_message.format(vm.name, str(ex)))
+            elif ex is not None:
+                traceback.print_exception(type(ex), ex, ex.__traceback__)
+
+        future = self.submit(vm, action, *args)
+        future.add_done_callback(report_error)
+        return future
+
+    async def run_many(self, vms, action):
+        ''' Call method `action` of all `vms`, `concurrency` at a time.
+        Returns a list of (vm, exception) tuples for calls that failed. '''
+        futures = [self.submit(vm, action) for vm in vms]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        return [(vm, result) for vm, result in zip(vms, results)
+                if isinstance(result, Exception)]
+
+
 class PauseItem(Gtk.ImageMenuItem):
     ''' Shutdown menu Item. When activated pauses the domain. '''
 
-    def __init__(self, vm, icon_cache):
+    def __init__(self, vm, app, icon_cache):
         super().__init__()
         self.vm = vm
+        self.app = app
 
         img = Gtk.Image.new_from_pixbuf(icon_cache.get_icon('pause'))
 
@@ -85,21 +358,19 @@ class PauseItem(Gtk.ImageMenuItem):
         self.connect('activate', self.perform_pause)
 
     def perform_pause(self, *_args, **_kwargs):
-        try:
-            self.vm.pause()
-        except exc.QubesException as ex:
-            show_error(_("Error pausing qube"),
-                       _("The following error occurred on an "
-                       "attempt to pause qube {0}:\n{1}").format(
-                           self.vm.name, str(ex)))
+        self.app.executor.run(
+            self.vm, 'pause', _("Error pausing qube"),
+            _("The following error occurred on an "
+              "attempt to pause qube {0}:\n{1}"))
 
 
 class UnpauseItem(Gtk.ImageMenuItem):
     ''' Unpause menu Item. When activated unpauses the domain. '''
 
-    def __init__(self, vm, icon_cache):
+    def __init__(self, vm, app, icon_cache):
         super().__init__()
         self.vm = vm
+        self.app = app
 
         img = Gtk.Image.new_from_pixbuf(icon_cache.get_icon('unpause'))
 
@@ -109,13 +380,10 @@ class UnpauseItem(Gtk.ImageMenuItem):
         self.connect('activate', self.perform_unpause)
 
     def perform_unpause(self, *_args, **_kwargs):
-        try:
-            self.vm.unpause()
-        except exc.QubesException as ex:
-            show_error(_("Error unpausing qube"),
-                       _("The following error occurred on an attempt "
-                       "to unpause qube {0}:\n{1}").format(
-                           self.vm.name, str(ex)))
+        self.app.executor.run(
+            self.vm, 'unpause', _("Error unpausing qube"),
+            _("The following error occurred on an attempt "
+              "to unpause qube {0}:\n{1}"))
 
 
 class ShutdownItem(Gtk.ImageMenuItem):
@@ -134,21 +402,19 @@ class ShutdownItem(Gtk.ImageMenuItem):
         self.connect('activate', self.perform_shutdown)
 
     def perform_shutdown(self, *_args, **_kwargs):
-        try:
-            self.vm.shutdown()
-        except exc.QubesException as ex:
-            show_error(_("Error shutting down qube"),
-                       _("The following error occurred on an attempt to "
-                       "shutdown qube {0}:\n{1}").format(
-                           self.vm.name, str(ex)))
+        self.app.executor.run(
+            self.vm, 'shutdown', _("Error shutting down qube"),
+            _("The following error occurred on an attempt to "
+              "shutdown qube {0}:\n{1}"))
 
 
 class KillItem(Gtk.ImageMenuItem):
     ''' Kill domain menu Item. When activated kills the domain. '''
 
-    def __init__(self, vm, icon_cache):
+    def __init__(self, vm, app, icon_cache):
         super().__init__()
         self.vm = vm
+        self.app = app
 
         img = Gtk.Image.new_from_pixbuf(icon_cache.get_icon('kill'))
 
@@ -158,12 +424,10 @@ class KillItem(Gtk.ImageMenuItem):
         self.connect('activate', self.perform_kill)
 
     def perform_kill(self, *_args, **_kwargs):
-        try:
-            self.vm.kill()
-        except exc.QubesException as ex:
-            show_error(_("Error shutting down qube"),
-                       _("The following error occurred on an attempt to "
-                       "shutdown qube {0}:\n{1}").format(self.vm.name, str(ex)))
+        self.app.executor.run(
+            self.vm, 'kill', _("Error shutting down qube"),
+            _("The following error occurred on an attempt to "
+              "shutdown qube {0}:\n{1}"))
 
 
 class PreferencesItem(Gtk.ImageMenuItem):
@@ -203,9 +467,10 @@ class LogItem(Gtk.ImageMenuItem):
 
 class RunTerminalItem(Gtk.ImageMenuItem):
     ''' Run Terminal menu Item. When activated runs a terminal emulator. '''
-    def __init__(self, vm, icon_cache):
+    def __init__(self, vm, app, icon_cache):
         super().__init__()
         self.vm = vm
+        self.app = app
 
         img = Gtk.Image.new_from_pixbuf(icon_cache.get_icon('terminal'))
 
@@ -215,21 +480,21 @@ class RunTerminalItem(Gtk.ImageMenuItem):
         self.connect('activate', self.run_terminal)
 
     def run_terminal(self, _item):
-        try:
-            self.vm.run_service('qubes.StartApp+qubes-run-terminal')
-        except exc.QubesException as ex:
-            show_error(_("Error starting terminal"),
-                       _("The following error occurred on an attempt to "
-                       "run terminal {0}:\n{1}").format(self.vm.name, str(ex)))
+        self.app.executor.run(
+            self.vm, 'run_service', _("Error starting terminal"),
+            _("The following error occurred on an attempt to "
+              "run terminal {0}:\n{1}"),
+            'qubes.StartApp+qubes-run-terminal')
 
 
 class OpenFileManagerItem(Gtk.ImageMenuItem):
     """Attempts to open a file manager in the VM. If failed, displayes an
     error message"""
 
-    def __init__(self, vm, icon_cache):
+    def __init__(self, vm, app, icon_cache):
         super().__init__()
         self.vm = vm
+        self.app = app
 
         img = Gtk.Image.new_from_pixbuf(
             icon_cache.get_icon('files'))
@@ -240,13 +505,11 @@ class OpenFileManagerItem(Gtk.ImageMenuItem):
         self.connect('activate', self.open_file_manager)
 
     def open_file_manager(self, _item):
-        try:
-            self.vm.run_service('qubes.StartApp+qubes-open-file-manager')
-        except exc.QubesException as ex:
-            show_error(_("Error opening file manager"),
-                       _("The following error occurred on an attempt to "
-                       "open file manager {0}:\n{1}").format(
-                           self.vm.name, str(ex)))
+        self.app.executor.run(
+            self.vm, 'run_service', _("Error opening file manager"),
+            _("The following error occurred on an attempt to "
+              "open file manager {0}:\n{1}"),
+            'qubes.StartApp+qubes-open-file-manager')
 
 
 class StartedMenu(Gtk.Menu):
@@ -258,10 +521,10 @@ class StartedMenu(Gtk.Menu):
         self.app = app
 
         self.add(PreferencesItem(self.vm, icon_cache))
-        self.add(PauseItem(self.vm, icon_cache))
+        self.add(PauseItem(self.vm, self.app, icon_cache))
         self.add(ShutdownItem(self.vm, self.app, icon_cache))
-        self.add(RunTerminalItem(self.vm, icon_cache))
-        self.add(OpenFileManagerItem(self.vm, icon_cache))
+        self.add(RunTerminalItem(self.vm, self.app, icon_cache))
+        self.add(OpenFileManagerItem(self.vm, self.app, icon_cache))
 
         self.show_all()
 
@@ -269,14 +532,15 @@ class StartedMenu(Gtk.Menu):
 class PausedMenu(Gtk.Menu):
     ''' The sub-menu for a paused domain'''
 
-    def __init__(self, vm, icon_cache):
+    def __init__(self, vm, app, icon_cache):
         super().__init__()
         self.vm = vm
+        self.app = app
 
         self.add(PreferencesItem(self.vm, icon_cache))
-        self.add(UnpauseItem(self.vm, icon_cache))
-        self.add(KillItem(self.vm, icon_cache))
-        self.add(RunTerminalItem(self.vm, icon_cache))
+        self.add(UnpauseItem(self.vm, self.app, icon_cache))
+        self.add(KillItem(self.vm, self.app, icon_cache))
+        self.add(RunTerminalItem(self.vm, self.app, icon_cache))
 
         self.show_all()
 
@@ -284,9 +548,10 @@ class PausedMenu(Gtk.Menu):
 class DebugMenu(Gtk.Menu):
     ''' Sub-menu providing multiple MenuItem for domain logs. '''
 
-    def __init__(self, vm, icon_cache):
+    def __init__(self, vm, app, icon_cache):
         super().__init__()
         self.vm = vm
+        self.app = app
 
         self.add(PreferencesItem(self.vm, icon_cache))
 
@@ -301,7 +566,7 @@ class DebugMenu(Gtk.Menu):
             if os.path.isfile(path):
                 self.add(LogItem(name, path))
 
-        self.add(KillItem(self.vm, icon_cache))
+        self.add(KillItem(self.vm, self.app, icon_cache))
 
         self.show_all()
 
@@ -330,6 +595,9 @@ class DomainMenuItem(Gtk.ImageMenuItem):
         self.vm = vm
         self.app = app
         self.icon_cache = icon_cache
+        # class of the submenu matching current state; the submenu itself
+        # is only built when the item gets selected
+        self.submenu_class = None
         # set vm := None to make this output headers.
         # Header menu item reuses the domain menu item code
         #   so headers are aligned with the columns.
@@ -340,7 +608,15 @@ class DomainMenuItem(Gtk.ImageMenuItem):
         # hbox.set_homogeneous(True)
 
         namebox = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
-        self.name = self.decorator.name()
+        if self.vm is None:
+            self.name = self.decorator.name()
+        else:
+            # only updateable domains show available updates
+            updates_state = False
+            if self.app.store.get_property(vm, 'updateable', False):
+                updates_state = self.app.store.get_feature(
+                    vm, 'updates-available', False)
+            self.name = self.decorator.name(updates_state)
         namebox.pack_start(self.name, True, True, 0)
         self.spinner = Gtk.Spinner()
         namebox.pack_start(self.spinner, False, True, 0)
@@ -367,9 +643,10 @@ class DomainMenuItem(Gtk.ImageMenuItem):
             self.set_reserve_indicator(True)  # align with submenu triangles
         else:
             if not state:
-                self.update_state(self.vm.get_power_state())
-            else:
-                self.update_state(state)
+                # the store fetches the state only if no event told it yet;
+                # a VM removed meanwhile is dropped by its domain-delete
+                state = self.app.store.get_state(self.vm) or 'Halted'
+            self.update_state(state)
             self.set_label_icon()
 
     def set_label_icon(self):
@@ -377,19 +654,38 @@ class DomainMenuItem(Gtk.ImageMenuItem):
 
     def _set_submenu(self, state):
         if state == 'Running':
-            submenu = StartedMenu(self.vm, self.app, self.icon_cache)
+            self.submenu_class = StartedMenu
         elif state == 'Paused':
-            submenu = PausedMenu(self.vm, self.icon_cache)
+            self.submenu_class = PausedMenu
         else:
-            submenu = DebugMenu(self.vm, self.icon_cache)
+            self.submenu_class = DebugMenu
+
+        current_submenu = self.get_submenu()
+        if current_submenu is None:
+            # empty placeholder, so that the submenu indicator is shown
+            self.set_submenu(Gtk.Menu())
+        elif current_submenu.get_mapped():
+            # the submenu is open, it has to be replaced right away
+            self.build_submenu()
+
+    def build_submenu(self):
+        current_submenu = self.get_submenu()
+        if isinstance(current_submenu, self.submenu_class):
+            # state changed, but the same actions are available
+            return
+        submenu = self.submenu_class(self.vm, self.app, self.icon_cache)
         # This is a workaround for a bug in Gtk which occurs when a
         # submenu is replaced while it is open.
         # see https://gitlab.gnome.org/GNOME/gtk/issues/885
-        current_submenu = self.get_submenu()
         if current_submenu:
             current_submenu.grab_remove()
         self.set_submenu(submenu)
 
+    def do_select(self):  # pylint: disable=arguments-differ
+        if self.submenu_class:
+            self.build_submenu()
+        Gtk.ImageMenuItem.do_select(self)
+
     def show_spinner(self):
         self.spinner.start()
         self.spinner.set_no_show_all(False)
@@ -440,7 +736,9 @@ class DomainMenuItem(Gtk.ImageMenuItem):
 class DomainTray(Gtk.Application):
     ''' A tray icon application listing all but halted domains. ” '''
 
-    def __init__(self, app_name, qapp, dispatcher, stats_dispatcher):
+    def __init__(self, app_name, qapp, dispatcher, stats_dispatcher,
+                 stats_interval=STATS_INTERVAL, qapp_factory=qubesadmin.Qubes):
+        # pylint: disable=too-many-arguments
         super().__init__()
         self.qapp = qapp
         self.dispatcher = dispatcher
@@ -455,22 +753,39 @@ class DomainTray(Gtk.Application):
         self.tray_menu = Gtk.Menu()
 
         self.icon_cache = IconCache()
+        self.store = DomainStateStore(qapp, dispatcher)
+        self.executor = ActionExecutor(qapp_factory=qapp_factory)
 
         self.menu_items = {}
-
-        self.unpause_all_action = Gio.SimpleAction.new('do-unpause-all', None)
-        self.unpause_all_action.connect('activate', self.do_unpause_all)
-        self.add_action(self.unpause_all_action)
+        # names of non-AdminVM domains in menu order, menu items of
+        # AdminVMs are placed right after the header
+        self.sorted_names = []
+        self.admin_vm_count = 0
+
+        for action in BULK_ACTIONS:
+            bulk_action = Gio.SimpleAction.new(
+                'do-{}-all'.format(action), None)
+            bulk_action.connect('activate', self.do_bulk_action, action)
+            self.add_action(bulk_action)
         self.pause_notification_out = False
+        # last result of have_running_and_all_are_paused()
+        self.all_paused = False
 
         # add refreshing tooltips with storage info
         GObject.timeout_add_seconds(120, self.refresh_tooltips)
 
+        # latest vm-stats sample of each domain, not yet shown in the menu
+        self.pending_stats = {}
+        GObject.timeout_add(stats_interval, self.flush_stats)
+
         self.register_events()
         self.set_application_id(app_name)
         self.register()  # register Gtk Application
 
     def register_events(self):
+        self.store.register_events()
+        self.store.state_listeners.append(self.check_pause_notify)
+
         self.dispatcher.add_handler('domain-pre-start', self.update_domain_item)
         self.dispatcher.add_handler('domain-start', self.update_domain_item)
         self.dispatcher.add_handler('domain-start-failed',
@@ -496,11 +811,6 @@ class DomainTray(Gtk.Application):
         self.dispatcher.add_handler('domain-shutdown-failed',
                                     self.emit_notification)
 
-        self.dispatcher.add_handler('domain-start', self.check_pause_notify)
-        self.dispatcher.add_handler('domain-paused', self.check_pause_notify)
-        self.dispatcher.add_handler('domain-unpaused', self.check_pause_notify)
-        self.dispatcher.add_handler('domain-shutdown', self.check_pause_notify)
-
         self.dispatcher.add_handler('domain-feature-set:updates-available',
                                     self.feature_change)
         self.dispatcher.add_handler('domain-feature-delete:updates-available',
@@ -511,6 +821,7 @@ class DomainTray(Gtk.Application):
         self.stats_dispatcher.add_handler('vm-stats', self.update_stats)
 
     def show_menu(self, _unused, _event):
+        self.apply_stats()
         self.tray_menu.popup_at_pointer(None)  # None means current event
 
     def emit_notification(self, vm, event, **kwargs):
@@ -564,32 +875,70 @@ class DomainTray(Gtk.Application):
             self.withdraw_notification('vms-paused')
             self.pause_notification_out = False
 
-    def do_unpause_all(self, _vm, *_args, **_kwargs):
-        for vm_name in self.menu_items:
-            try:
-                self.qapp.domains[vm_name].unpause()
-            except exc.QubesException:
-                # we may not have permission to do that
-                pass
+    def do_bulk_action(self, _gio_action, _parameter, action):
+        if action not in CONFIRMED_BULK_ACTIONS:
+            asyncio.ensure_future(self.perform_bulk_action(action))
+            return
+        count = len(self.get_bulk_action_vms(action))
+        if not count:
+            return
+        dialog = Gtk.MessageDialog(
+            None, 0, Gtk.MessageType.QUESTION, Gtk.ButtonsType.YES_NO)
+        dialog.set_title(_('Qubes Domains'))
+        dialog.set_markup(CONFIRMED_BULK_ACTIONS[action].format(count))
+
+        def on_response(_dialog, response):
+            dialog.destroy()
+            if response == Gtk.ResponseType.YES:
+                asyncio.ensure_future(self.perform_bulk_action(action))
+        dialog.connect('response', on_response)
+        dialog.show()
+
+    def get_bulk_action_vms(self, action):
+        ''' Domains in a state `action` applies to, from the state store '''
+        states = BULK_ACTIONS[action][0]
+        return [vm for vm in self.menu_items
+                if self.store.get_property(vm, 'klass') != 'AdminVM'
+                and self.store.get_state(vm) in states]
+
+    async def perform_bulk_action(self, action):
+        ''' Perform `action` on all domains in a state the action applies
+        to, reporting progress and failures in a single notification '''
+        _states, progress, success, failure = BULK_ACTIONS[action]
+        vms = self.get_bulk_action_vms(action)
+        if not vms:
+            return
+
+        notification = Gio.Notification.new(progress.format(len(vms)))
+        notification.set_priority(Gio.NotificationPriority.NORMAL)
+        self.send_notification('bulk-action', notification)
+
+        failures = await self.executor.run_many(vms, action)
+
+        if failures:
+            notification = Gio.Notification.new(
+                failure.format(len(failures), len(vms)))
+            notification.set_body('\n'.join(
+                '{}: {}'.format(vm.name, ex) for vm, ex in failures))
+            notification.set_priority(Gio.NotificationPriority.HIGH)
+            notification.set_icon(Gio.ThemedIcon.new('dialog-warning'))
+        else:
+            notification = Gio.Notification.new(success.format(len(vms)))
+            notification.set_priority(Gio.NotificationPriority.NORMAL)
+        self.send_notification('bulk-action', notification)
 
-    def check_pause_notify(self, _vm, _event, **_kwargs):
-        if self.have_running_and_all_are_paused():
+    def check_pause_notify(self, _vm, _old_state, _new_state):
+        all_paused = self.have_running_and_all_are_paused()
+        if all_paused == self.all_paused:
+            return
+        self.all_paused = all_paused
+        if all_paused:
             self.emit_paused_notification()
         else:
             self.withdraw_paused_notification()
 
     def have_running_and_all_are_paused(self):
-        found_paused = False
-        for vm in self.qapp.domains:
-            if vm.klass != 'AdminVM':
-                if vm.is_running():
-                    if vm.is_paused():
-                        # a running that is paused
-                        found_paused = True
-                    else:
-                        # found running that wasn't paused
-                        return False
-        return found_paused
+        return self.store.have_running_and_all_are_paused()
 
     def add_domain_item(self, _submitter, event, vm, **_kwargs):
         """Add a DomainMenuItem to menu; if event is None, this was fired
@@ -608,35 +957,24 @@ class DomainTray(Gtk.Application):
 
         state = STATE_DICTIONARY.get(event)
         if not state:
-            try:
-                state = vm.get_power_state()
-            except exc.QubesException:
-                # VM might have been already destroyed
-                if vm not in self.qapp.domains:
-                    return
-                # or we might not have permission to access its power state
-                state = 'Halted'
+            state = self.store.get_state(vm)
+            if state is None:
+                # the VM was deleted while its state was being fetched
+                return
 
         domain_item = DomainMenuItem(vm, self, self.icon_cache, state=state)
+        # the header comes first, then AdminVMs, then the rest sorted by name
+        if self.store.get_property(vm, 'klass') == 'AdminVM':
+            position = 1 + self.admin_vm_count
+            self.admin_vm_count += 1
+        else:
+            index = bisect.bisect_right(self.sorted_names, vm.name)
+            self.sorted_names.insert(index, vm.name)
+            position = 1 + self.admin_vm_count + index
         if not event:  # menu item creation at widget start; we can assume
             # menu items are created in alphabetical order
             self.tray_menu.add(domain_item)
         else:
-            position = 0
-            for i in self.tray_menu:  # pylint: disable=not-an-iterable
-                if not hasattr(i, 'vm'):  # we reached the end
-                    break
-                if not i.vm:  # header should be skipper
-                    position += 1
-                    continue
-                if i.vm.klass == 'AdminVM':
-                    # AdminVM(s) should be skipped
-                    position += 1
-                    continue
-                if i.vm.name > vm.name:
-                    # we reached correct alphabetical placement for the VM
-                    break
-                position += 1
             self.tray_menu.insert(domain_item, position)
         self.menu_items[vm] = domain_item
 
@@ -648,10 +986,14 @@ class DomainTray(Gtk.Application):
         elif event == 'property-set:label':
             self.menu_items[vm].set_label_icon()
 
-    def feature_change(self, vm, *_args, **_kwargs):
+    def feature_change(self, vm, event, **kwargs):
         if vm not in self.menu_items:
             return
-        self.menu_items[vm].name.update_updateable()
+        if event.startswith('domain-feature-set:'):
+            updates_state = bool(kwargs.get('value'))
+        else:
+            updates_state = False
+        self.menu_items[vm].name.update_updateable(updates_state)
 
     def refresh_tooltips(self):
         for item in self.menu_items.values():
@@ -665,8 +1007,16 @@ class DomainTray(Gtk.Application):
         if vm not in self.menu_items:
             return
         vm_widget = self.menu_items[vm]
+        index = bisect.bisect_left(self.sorted_names, str(vm))
+        if index < len(self.sorted_names) and \
+                self.sorted_names[index] == str(vm):
+            del self.sorted_names[index]
+        else:
+            # only AdminVMs are not in the sorted index
+            self.admin_vm_count -= 1
         self.tray_menu.remove(vm_widget)
         del self.menu_items[vm]
+        self.pending_stats.pop(vm, None)
 
     def update_domain_item(self, vm, event, **kwargs):
         ''' Update the menu item with the started menu for
@@ -680,30 +1030,30 @@ class DomainTray(Gtk.Application):
             return
         except KeyError:
             self.add_domain_item(None, event, vm)
-            item = self.menu_items[vm]
+            item = self.menu_items.get(vm)
+            if item is None:
+                # the VM is already gone
+                return
 
         if event in STATE_DICTIONARY:
             state = STATE_DICTIONARY[event]
         else:
-            try:
-                state = vm.get_power_state()
-            except Exception: # pylint: disable=broad-except
-                # it's a fragile DispVM
-                state = "Transient"
+            state = self.store.get_state(vm, fallback='Transient')
+            if state is None:
+                self.remove_domain_item(None, event, vm)
+                return
 
         item.update_state(state)
 
         if event == 'domain-shutdown':
             if getattr(vm, 'klass', None) == 'TemplateVM':
                 for menu_item in self.menu_items.values():
-                    try:
-                        if not menu_item.vm.is_running():
-                            # A VM based on this template can only be
-                            # outdated if the VM is currently running.
-                            continue
-                    except exc.QubesPropertyAccessError:
+                    if not self.store.is_running(menu_item.vm):
+                        # A VM based on this template can only be
+                        # outdated if the VM is currently running.
                         continue
-                    if getattr(menu_item.vm, 'template', None) == vm:
+                    if self.store.get_property(
+                            menu_item.vm, 'template') == vm:
                         menu_item.name.update_outdated(True)
             # if the VM was shut down, it is no longer outdated
             item.name.update_outdated(False)
@@ -718,30 +1068,43 @@ class DomainTray(Gtk.Application):
     def update_stats(self, vm, _event, **kwargs):
         if vm not in self.menu_items:
             return
-        self.menu_items[vm].update_stats(
-            kwargs['memory_kb'], kwargs['cpu_usage'])
+        self.pending_stats[vm] = (kwargs['memory_kb'], kwargs['cpu_usage'])
+
+    def flush_stats(self):
+        # nobody can see the stats while the menu is closed; they are
+        # applied when it is opened
+        if self.pending_stats and self.tray_menu.get_mapped():
+            self.apply_stats()
+        return True  # needed for Gtk to correctly loop the function
+
+    def apply_stats(self):
+        for vm, (memory_kb, cpu_usage) in self.pending_stats.items():
+            if vm in self.menu_items:
+                self.menu_items[vm].update_stats(memory_kb, cpu_usage)
+        self.pending_stats.clear()
 
     def initialize_menu(self):
+        self.store.seed()
+
         self.tray_menu.add(DomainMenuItem(None, self, self.icon_cache))
 
         # Add AdminVMS
         for vm in sorted([vm for vm in self.qapp.domains
-                          if vm.klass == "AdminVM"]):
+                          if self.store.get_property(vm, 'klass') ==
+                          "AdminVM"]):
             self.add_domain_item(None, None, vm)
 
         # and the rest of them
         for vm in sorted([vm for vm in self.qapp.domains
-                          if vm.klass != 'AdminVM']):
+                          if self.store.get_property(vm, 'klass') !=
+                          'AdminVM']):
             self.add_domain_item(None, None, vm)
 
         for item in self.menu_items.values():
-            try:
-                if item.vm and item.vm.is_running():
-                    item.name.update_tooltip(storage_changed=True)
-                    item.show_all()
-                else:
-                    item.hide()
-            except exc.QubesPropertyAccessError:
+            if item.vm and self.store.is_running(item.vm):
+                item.name.update_tooltip(storage_changed=True)
+                item.show_all()
+            else:
                 item.hide()
 
         self.tray_menu.add(Gtk.SeparatorMenuItem())
@@ -783,12 +1146,8 @@ class DomainTray(Gtk.Application):
         self.dispatcher.remove_handler('domain-shutdown-failed',
                                        self.emit_notification)
 
-        self.dispatcher.remove_handler('domain-start', self.check_pause_notify)
-        self.dispatcher.remove_handler('domain-paused', self.check_pause_notify)
-        self.dispatcher.remove_handler('domain-unpaused',
-                                       self.check_pause_notify)
-        self.dispatcher.remove_handler('domain-shutdown',
-                                       self.check_pause_notify)
+        self.store.state_listeners.remove(self.check_pause_notify)
+        self.store.unregister_events()
 
         self.dispatcher.remove_handler('domain-feature-set:updates-available',
                                        self.feature_change)
@@ -802,21 +1161,29 @@ class DomainTray(Gtk.Application):
         self.stats_dispatcher.remove_handler('vm-stats', self.update_stats)
 
 
-def main():
-    ''' main function '''
-    qapp = qubesadmin.Qubes()
-    dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+def load_widget(qapp, dispatcher, qapp_factory=qubesadmin.Qubes):
+    ''' Create the widget for `qui.tray.host`; returns the application and
+    coroutines that have to run along with the events dispatcher.
+    `qapp_factory` makes Qubes objects for worker threads. '''
     stats_dispatcher = qubesadmin.events.EventsDispatcher(
         qapp, api_method='admin.vm.Stats')
     app = DomainTray(
-        'org.qubes.qui.tray.Domains', qapp, dispatcher, stats_dispatcher)
+        'org.qubes.qui.tray.Domains', qapp, dispatcher, stats_dispatcher,
+        qapp_factory=qapp_factory)
     app.run()
+    return app, [stats_dispatcher.listen_for_events()]
+
+
+def main():
+    ''' main function '''
+    logging.basicConfig(level=logging.INFO)
+    qapp = qubesadmin.Qubes()
+    dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+    _app, coroutines = load_widget(qapp, dispatcher)
 
     loop = asyncio.get_event_loop()
-    tasks = [
-        asyncio.ensure_future(dispatcher.listen_for_events()),
-        asyncio.ensure_future(stats_dispatcher.listen_for_events()),
-    ]
+    tasks = [asyncio.ensure_future(dispatcher.listen_for_events())]
+    tasks.extend(asyncio.ensure_future(c) for c in coroutines)
 
     done, _unused = loop.run_until_complete(asyncio.wait(
             tasks, return_when=asyncio.FIRST_EXCEPTION))
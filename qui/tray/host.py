@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# pylint: disable=wrong-import-position,import-error
+''' Runs several widgets in a single process.
+
+Every widget module provides `load_widget(qapp, dispatcher)`. The host
+imports the selected widgets and runs them on one gbulb loop, with one
+`qubesadmin.Qubes` object and one events dispatcher (so one `admin.Events`
+stream) shared between them. Each widget keeps its own tray icon and
+application ID. This is optional: the widgets can still be run as separate
+programs.
+'''
+import argparse
+import asyncio
+import importlib
+import logging
+import sys
+import traceback
+
+import gi
+gi.require_version('Gtk', '3.0')  # isort:skip
+from gi.repository import Gtk  # isort:skip
+
+import qubesadmin
+import qubesadmin.events
+
+import gbulb
+gbulb.install()
+
+import gettext
+t = gettext.translation("desktop-linux-manager", localedir="/usr/locales",
+                        fallback=True)
+_ = t.gettext
+
+#: widget name -> module providing load_widget()
+WIDGETS = {
+    'domains': 'qui.tray.domains',
+    'devices': 'qui.tray.devices',
+    'disk-space': 'qui.tray.disk_space',
+    'updates': 'qui.tray.updates',
+    'clipboard': 'qui.clipboard',
+}
+
+parser = argparse.ArgumentParser(
+    description='Run several Qubes widgets in a single process.')
+parser.add_argument(
+    'widgets', metavar='WIDGET', nargs='*',
+    help='widgets to run, from: {} (default: all)'.format(
+        ', '.join(WIDGETS)))
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    names = args.widgets or list(WIDGETS)
+    for name in names:
+        if name not in WIDGETS:
+            parser.error('unknown widget: {}'.format(name))
+
+    # import all modules before the loop is created, as each of them
+    # installs gbulb
+    modules = [importlib.import_module(WIDGETS[name]) for name in names]
+
+    logging.basicConfig(level=logging.INFO)
+    qapp = qubesadmin.Qubes()
+    dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+
+    loop = asyncio.get_event_loop()
+
+    apps = []
+    tasks = [asyncio.ensure_future(dispatcher.listen_for_events())]
+    for module in modules:
+        app, coroutines = module.load_widget(qapp, dispatcher)
+        apps.append(app)
+        tasks.extend(asyncio.ensure_future(c) for c in coroutines)
+
+    done, _unused = loop.run_until_complete(asyncio.wait(
+        tasks, return_when=asyncio.FIRST_EXCEPTION))
+
+    exit_code = 0
+    for d in done:  # pylint: disable=invalid-name
+        try:
+            d.result()
+        except Exception:  # pylint: disable=broad-except
+            exc_type, exc_value = sys.exc_info()[:2]
+            dialog = Gtk.MessageDialog(
+                None, 0, Gtk.MessageType.ERROR, Gtk.ButtonsType.OK)
+            dialog.set_title(_("Houston, we have a problem..."))
+            dialog.set_markup(_(
+                "<b>Whoops. A critical error in Qubes widgets has occured.</b>"
+                " This is most likely a bug in the widgets. To restart them, "
+                "run 'qui-widgets' in dom0."))
+            dialog.format_secondary_markup(
+                "\n<b>{}</b>: {}\n{}".format(
+                   exc_type.__name__, exc_value, traceback.format_exc(limit=10)
+                ))
+            dialog.run()
+            exit_code = 1
+    del apps
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -161,17 +161,30 @@ class UpdatesTray(Gtk.Application):
             self.widget_icon.set_visible(False)
 
 
-def main():
-    qapp = qubesadmin.Qubes()
-    dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+def load_widget(qapp, dispatcher, qapp_factory=None):
+    ''' Create the widget for `qui.tray.host`; returns the application and
+    coroutines that have to run along with the events dispatcher.
+    `qapp_factory` is not used, as the widget makes all its calls in the
+    main thread. '''
+    # pylint: disable=unused-argument
     app = UpdatesTray(
         'org.qubes.qui.tray.Updates', qapp, dispatcher)
     app.run()
+    return app, []
+
+
+def main():
+    qapp = qubesadmin.Qubes()
+    dispatcher = qubesadmin.events.EventsDispatcher(qapp)
+    _app, coroutines = load_widget(qapp, dispatcher)
 
     loop = asyncio.get_event_loop()
 
-    done, _unused = loop.run_until_complete(asyncio.ensure_future(
-        dispatcher.listen_for_events()))
+    tasks = [asyncio.ensure_future(dispatcher.listen_for_events())]
+    tasks.extend(asyncio.ensure_future(c) for c in coroutines)
+
+    done, _unused = loop.run_until_complete(asyncio.wait(
+        tasks, return_when=asyncio.FIRST_EXCEPTION))
 
     exit_code = 0
 
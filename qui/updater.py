@@ -2,17 +2,19 @@
 # -*- coding: utf-8 -*-
 # pylint: disable=wrong-import-position,import-error
 
+import os
 import re
 import time
 import threading
 import subprocess
-import pkg_resources
 import gi  # isort:skip
 gi.require_version('Gtk', '3.0')  # isort:skip
 from gi.repository import Gtk, Gdk, GObject, Gio  # isort:skip
 from qubesadmin import Qubes
 from qubesadmin import exc
 
+import qui.icons
+
 # using locale.gettext is necessary for Gtk.Builder translation support to work
 # in most cases gettext is better, but it cannot handle Gtk.Builder/glade files
 import locale
@@ -37,8 +39,10 @@ class QubesUpdater(Gtk.Application):
         # pylint: disable=attribute-defined-outside-init
         self.builder = Gtk.Builder()
         self.builder.set_translation_domain("desktop-linux-manager")
-        self.builder.add_from_file(pkg_resources.resource_filename(
-            __name__, 'updater.glade'))
+        # updater.glade is installed next to this module (see setup.py);
+        # pkg_resources would find it as well, but importing it is slow
+        self.builder.add_from_file(os.path.join(
+            os.path.dirname(__file__), 'updater.glade'))
 
         self.main_window = self.builder.get_object("main_window")
 
@@ -269,7 +273,7 @@ class QubesUpdater(Gtk.Application):
 
 
 def get_domain_icon(vm):
-    icon_vm = Gtk.IconTheme.get_default().load_icon(vm.label.icon, 16, 0)
+    icon_vm = qui.icons.load_icon(vm.label.icon)
     icon_img = Gtk.Image.new_from_pixbuf(icon_vm)
     return icon_img
 
@@ -309,8 +313,7 @@ class VMListBoxRow(Gtk.ListBoxRow):
                     vm.features.get('gui', False) and \
                     not vm.features.get('os', False):
                 warn_icon = Gtk.Image.new_from_pixbuf(
-                    Gtk.IconTheme.get_default().load_icon(
-                        'dialog-warning', 12, 0))
+                    qui.icons.load_icon('dialog-warning', 12))
                 warn_icon.set_tooltip_text(
                     'This qube may have been restored from an older version of '
                     'Qubes and may not be able to update itself correctly. '
@@ -40,7 +40,8 @@ setuptools.setup(name='qui',
               'qui-disk-space = qui.tray.disk_space:main',
               'qui-updates = qui.tray.updates:main',
               'qubes-update-gui = qui.updater:main',
-              'qui-clipboard = qui.clipboard:main'
+              'qui-clipboard = qui.clipboard:main',
+              'qui-widgets = qui.tray.host:main'
           ]
       },
       package_data={'qui': ["updater.glade"]},